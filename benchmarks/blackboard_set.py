@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Measures the cost of a :meth:`rowan.utils.blackboard.Blackboard.set`
+context, as used by routers, SetParams and middleware on every
+request. For comparison, the original ``contextlib``-based
+implementation is timed on the same workloads.
+"""
+
+from __future__ import with_statement
+import contextlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from rowan.utils.blackboard import Blackboard
+
+class ContextlibBlackboard(Blackboard):
+    """The implementation of Blackboard.set before it was optimised."""
+
+    @contextlib.contextmanager
+    def set(self, **kws):
+        old_values = {}
+        new_values = []
+        for key, value in kws.items():
+            components = key.split('__')
+            obj = self
+            found_new = False
+            for component in components[:-1]:
+                if hasattr(obj, component):
+                    obj = getattr(obj, component)
+                else:
+                    if not found_new:
+                        new_values.append((obj, component))
+                        found_new = True
+                    blackboard = Blackboard()
+                    setattr(obj, component, blackboard)
+                    obj = blackboard
+            last_component = components[-1]
+            if hasattr(obj, last_component):
+                old_values[(obj, last_component)]=getattr(obj, last_component)
+            elif not found_new:
+                new_values.append((obj, last_component))
+            setattr(obj, last_component, value)
+        try:
+            yield
+        finally:
+            for (obj, key), value in old_values.items():
+                setattr(obj, key, value)
+            for (obj, key) in reversed(new_values):
+                delattr(obj, key)
+
+def make_workloads(cls):
+    """
+    Returns named functions that each enter and leave one context, in
+    the styles used by the controllers.
+    """
+    board = cls()
+    board.path = '/blog/2010/'
+    board.router_args = ()
+    board.settings = Blackboard()
+    board.settings.shock = 'Boo'
+
+    def router():
+        with board.set(router_args=('2010',), router_kws={},
+                       path_stack=['/blog/2010/'], path=''):
+            pass
+
+    def set_params():
+        with board.set(settings__shock='loud', services__templates=None):
+            pass
+
+    def middleware():
+        with board.set(session={}):
+            pass
+
+    return [('router', router), ('set_params', set_params),
+            ('middleware', middleware)]
+
+def main(number=100000):
+    print "%-12s %12s %12s %8s" % ('workload', 'contextlib', 'current', 'ratio')
+    old = make_workloads(ContextlibBlackboard)
+    new = make_workloads(Blackboard)
+    for (name, old_fn), (_, new_fn) in zip(old, new):
+        old_time = min(timeit.repeat(old_fn, number=number, repeat=5))
+        new_time = min(timeit.repeat(new_fn, number=number, repeat=5))
+        print "%-12s %10.3fus %10.3fus %7.2fx" % (
+            name, old_time / number * 1e6, new_time / number * 1e6,
+            old_time / new_time
+            )
+
+if __name__ == '__main__':
+    main()
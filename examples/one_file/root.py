@@ -1,8 +1,8 @@
 import os
 import logging
-import jinja2
 
 from rowan import http
+from rowan import templates
 from rowan.controllers import *
 
 # View functions
@@ -16,17 +16,16 @@ def greet_someone(request):
 def shock_someone(request):
     logging.getLogger('shock_someone').debug('Called')
     template = request.services.templates.get_template('message.html')
-    content = template.render(message=request.settings.shock)
-    return http.HttpResponse(content.encode('ascii', 'ignore'))
+    return templates.render_response(
+        template, {'message': request.settings.shock}
+        )
 
 
 # Build the root of this application
 def _create_root_controller():
     # Create the environment and template loader
     template_path = os.path.join(os.path.split(__file__)[0], 'templates')
-    environment = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(template_path)
-        )
+    environment = templates.get_environment(template_path)
 
     target_urls = Router(
         (r'^(?P<name>\w+)/$', greet_someone)
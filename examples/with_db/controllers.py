@@ -1,7 +1,7 @@
 import logging
 import sqlalchemy
 
-import rowan.http as http
+import rowan.templates as templates
 
 import models
 
@@ -16,5 +16,4 @@ def view_blog(request):
 
     # Load the template and render
     template = request.services.templates.get_template('view_blog.html')
-    content = template.render(entries=entries)
-    return http.HttpResponse(content.encode('ascii', 'ignore'))
+    return templates.render_response(template, {'entries': entries})
@@ -2,12 +2,12 @@ from __future__ import with_statement
 import os
 import logging
 
-import jinja2
 import sqlalchemy
 
 from rowan import http
 from rowan.controllers import *
 from rowan import db
+from rowan import templates
 
 import urls
 import models
@@ -16,9 +16,7 @@ import models
 def _create_root_node():
     # Set up the services.
     template_path = os.path.join(os.path.dirname(__file__), 'templates')
-    templates = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(template_path)
-        )
+    environment = templates.get_environment(template_path)
 
     connection_string = 'sqlite:///%s/database.db' % \
         os.path.abspath(os.path.join(os.path.dirname(__file__)))
@@ -31,7 +29,7 @@ def _create_root_node():
                 connection_string=connection_string
                 )
             ),
-        services__templates=templates
+        services__templates=environment
         )
     return root
 
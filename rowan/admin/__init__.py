@@ -1,9 +1,7 @@
 import os
 
-import jinja2
-
-import rowan.http as http
 import rowan.controllers as controllers
+import rowan.templates as templates
 
 class AdminApp(controllers.Router):
     """
@@ -14,7 +12,9 @@ class AdminApp(controllers.Router):
 
         # Set up the routing paths.
         assert "/" not in media_dir, "Media dir must be a single directory."
-        content_server = controllers.ContentServer(os.path.join(path, "media"))
+        content_server = controllers.ContentServer(
+            os.path.join(path, "media"), precompressed=True
+            )
         super(AdminApp, self).__init__(
             (r"^%s/" % media_dir, content_server),
             (r"^$", self.view_home)
@@ -25,15 +25,12 @@ class AdminApp(controllers.Router):
 
         # Template handling
         template_path = os.path.join(path, 'templates')
-        self.template_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_path)
-            )
+        self.template_env = templates.get_environment(template_path)
 
     def _render_template(self, template_name, **data):
         template = self.template_env.get_template(template_name)
         if 'media_dir' not in data: data['media_dir'] = self.media_dir
-        content = template.render(**data)
-        return http.HttpResponse(content.encode('ascii', 'ignore'))
+        return templates.render_response(template, data, stream=True)
 
     def view_home(self, request):
         """Displays the summary screen for the homepage of the app."""
@@ -8,26 +8,45 @@ class Application(object):
     normally the object you pass to the server as your WSGI application. It
     acts as an interface between WSGI's calling API and our internal
     request/response format. Pass the top level request/response handler
-    into the constructor."""
+    into the constructor.
 
-    def __init__(self, controller):
+    If ``compile_tree`` is true, the tree is analysed once, when the
+    application is created, and rebuilt so that requests pass through
+    fewer controllers (see :mod:`rowan.controllers.compiler`). The
+    original tree is left untouched."""
+
+    def __init__(self, controller, compile_tree=False):
+        if compile_tree:
+            import rowan.controllers.compiler as compiler
+            controller = compiler.compile_tree(controller)
         self.controller = controller
 
     def __call__(self, environ, start_response):
         request = http.HttpRequest(environ)
         response = self.controller(request)
         start_response(response.status_code_string, response.headers)
-        return [response.content]
+        return response.iter_content(environ.get('wsgi.file_wrapper'))
 
-    def simple_serve(self, host='0.0.0.0', port=8000):
+    def simple_serve(self, host='0.0.0.0', port=8000, threads=0):
         """Sets up a development WSGI webserver at the given location, serving
-        this application."""
-        from wsgiref.simple_server import make_server
-        srv = make_server(host, port, self)
+        this application. If ``threads`` is given, requests are handled by
+        that many threads, so slow requests don't hold up the others."""
+        from rowan.server import make_server
+        srv = make_server(host, port, self, threads)
         print "Development server is running at http://%s:%d/" % (
             host, port
             )
         print "Quit the server with CONTROL-C"
         srv.serve_forever()
 
-
+    def prefork_serve(self, host='0.0.0.0', port=8000, workers=None,
+                      max_requests=0, threads=0):
+        """Serves this application from a pool of worker processes, for
+        production use (see :class:`rowan.server.PreforkServer`)."""
+        from rowan.server import PreforkServer
+        srv = PreforkServer(self, host, port, workers, max_requests, threads)
+        srv.bind()
+        print "Server is running at http://%s:%d/ with %d workers" % (
+            host, srv.port, srv.workers
+            )
+        srv.serve_forever()
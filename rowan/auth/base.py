@@ -145,4 +145,9 @@ class AuthChannel(object):
         if current_data != new_data:
             user_auth_data = user_obj.setdefault('auth', {})
             user_auth_data[self.get_channel_key()] = self.create_user_data()
+            user_obj['version'] = user_obj.get('version', 0) + 1
             db.user.save(user_obj)
+
+            # Don't let cached copies of the user hide the change.
+            from rowan.controllers.middleware import UserMiddleware
+            UserMiddleware.invalidate(current_user_id)
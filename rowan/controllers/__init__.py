@@ -11,6 +11,7 @@ This package contains a range of basic controllers.
 from core import *
 from middleware import *
 from content import *
+from cache import *
 
 def wrapper_as_decorator(WrapperClass, *args, **kws):
     """
@@ -0,0 +1,205 @@
+"""Controllers that save work by reusing earlier responses."""
+
+from __future__ import with_statement
+from urlparse import parse_qsl
+import hashlib
+import threading
+import urllib
+
+import rowan.http as http
+from rowan.utils.cache import LRUCache
+import base
+
+class ResponseCache(base.Wrapper):
+    """
+    Wraps another controller, storing its responses in memory and
+    returning the stored copy to later requests for the same page,
+    without calling the controller again. Use it for pages that are
+    the same for everyone who sees them (e.g. anonymous users).
+
+    Responses are stored by method, the full path (not just the part
+    left by the routers above), the values routers captured from the
+    path, and the query string (with its parameters in a standard
+    order). If the page depends on other
+    parts of the request, name them in ``vary_cookies`` or
+    ``vary_headers`` (as WSGI environment keys, e.g.
+    ``HTTP_ACCEPT_LANGUAGE``) and a separate copy is stored for each
+    value they take. Only responses to ``methods`` with a status in
+    ``status_codes`` are stored. Responses that set cookies, streamed
+    responses and responses with ``cacheable`` set to False are never
+    stored.
+
+    Responses are kept for ``ttl`` seconds, up to a total of
+    ``max_size`` bytes of content, after which the least recently used
+    are discarded. When a page isn't in the cache, only one request
+    generates it: other requests for the same page wait for that
+    response rather than all generating their own.
+    """
+    def __init__(self, controller, ttl=60, max_size=10*1024*1024,
+                 vary_cookies=(), vary_headers=(), methods=('GET', 'HEAD'),
+                 status_codes=(200,)):
+        super(ResponseCache, self).__init__(controller)
+        self.vary_cookies = tuple(vary_cookies)
+        self.vary_headers = tuple(vary_headers)
+        self.methods = frozenset(methods)
+        self.status_codes = frozenset(status_codes)
+        self.cache = LRUCache(max_size, size_of=_entry_size, ttl=ttl)
+        # Maps the key of each page being generated to an event set when
+        # it is done.
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, request):
+        """Returns the key the response to the given request is stored by."""
+        query = urllib.urlencode(sorted(
+            parse_qsl(request.query_raw, keep_blank_values=True)
+            ))
+        # Routers above us only leave us part of the path, so use the
+        # whole of it, and anything they captured from it.
+        env = request.REQUEST
+        key = (
+            request.method, env.get('SCRIPT_NAME', ''),
+            env.get('PATH_INFO', ''), query,
+            tuple(getattr(request, 'router_args', ())),
+            tuple(sorted(getattr(request, 'router_kws', {}).items()))
+            )
+        if self.vary_cookies:
+            cookies = request.cookies
+            key += tuple(cookies.get(name) for name in self.vary_cookies)
+        if self.vary_headers:
+            key += tuple(
+                request.REQUEST.get(name) for name in self.vary_headers
+                )
+        return key
+
+    def __call__(self, request):
+        if request.method not in self.methods:
+            return self.controller(request)
+
+        key = self.get_key(request)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return _build_response(entry)
+
+        with self._lock:
+            done = self._pending.get(key)
+            if done is None:
+                self._pending[key] = threading.Event()
+
+        if done is not None:
+            # Another request is generating this page, use its response.
+            done.wait()
+            entry = self.cache.get(key)
+            if entry is not None:
+                return _build_response(entry)
+            return self.controller(request)
+
+        try:
+            response = self.controller(request)
+            entry = self._make_entry(response)
+            if entry is not None:
+                self.cache.set(key, entry)
+            return response
+        finally:
+            with self._lock:
+                done = self._pending.pop(key)
+            done.set()
+
+    def _make_entry(self, response):
+        """
+        Returns what should be stored for the given response, or None
+        if it shouldn't be stored.
+        """
+        if (not response.cacheable or response.streaming or
+            response.status_code not in self.status_codes):
+            return None
+        # Use all the headers, as subclasses can add their own (such as
+        # a redirect's Location).
+        headers = []
+        for name, value in response.headers:
+            lower_name = name.lower()
+            if lower_name == 'set-cookie':
+                return None
+            elif lower_name != 'content-type':
+                headers.append((name, value))
+        return (
+            response.status_code, response.content_type, headers,
+            response.content
+            )
+
+class ConditionalGet(base.Wrapper):
+    """
+    Wraps another controller, adding an ``ETag`` header to its
+    successful responses, and replying with a bodiless 304 response
+    when the user's cached copy has the same ETag.
+
+    If the controller gives its response an ETag, that is used,
+    otherwise the ETag is a hash of the response's content (streamed
+    responses, which would have to be held in memory to be hashed, are
+    left alone). Either way, the controller still generates the page.
+    To skip generating unchanged pages, give a ``get_version``
+    function: it is called with the request and returns a string that
+    changes whenever the page does (e.g. the modification count of the
+    document it displays), or None if it can't tell. The ETag is then
+    made from the version before the controller is called.
+
+    ETags are strong, unless ``weak`` is true: use weak ETags if the
+    content can change in ways that don't matter (such as being
+    compressed differently).
+    """
+    def __init__(self, controller, get_version=None, weak=False):
+        super(ConditionalGet, self).__init__(controller)
+        self.get_version = get_version
+        self.weak = weak
+
+    def make_etag(self, data):
+        """Returns an ETag for the given version or content."""
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.weak:
+            etag = 'W/' + etag
+        return etag
+
+    def __call__(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return self.controller(request)
+
+        etag = None
+        if self.get_version is not None:
+            version = self.get_version(request)
+            if version is not None:
+                etag = self.make_etag(str(version))
+                if http.is_not_modified(request, etag):
+                    return http.Http304([('ETag', etag)])
+
+        response = self.controller(request)
+        if response.status_code != 200:
+            return response
+
+        for name, value in response.extra_headers:
+            if name.lower() == 'etag':
+                etag = value
+                break
+        else:
+            if etag is None:
+                if response.streaming:
+                    return response
+                etag = self.make_etag(response.content)
+            response.extra_headers.append(('ETag', etag))
+
+        if http.is_not_modified(request, etag):
+            # Keep headers such as Cache-Control and Set-Cookie, but
+            # not those describing the content.
+            return http.Http304([
+                (name, value) for name, value in response.extra_headers
+                if not name.lower().startswith('content-')
+                ])
+        return response
+
+def _entry_size(entry):
+    return len(entry[3])
+
+def _build_response(entry):
+    status_code, content_type, headers, content = entry
+    response = http.HttpResponse(content, content_type, status_code)
+    response.extra_headers = list(headers)
+    return response
@@ -0,0 +1,153 @@
+"""
+Rewrites a controller tree into an equivalent tree that does less work
+per request.
+
+Trees are usually built for readability, so a request often passes
+through several layers that could be combined: consecutive
+:class:`~rowan.controllers.core.SetParams` controllers, routers nested
+directly inside routers, or fallbacks with only one option. Each layer
+costs a function call, and usually a change to the request context.
+:func:`compile_tree` is run once, before the tree starts serving
+requests, and removes these layers without changing the behavior of
+the tree. Controllers it doesn't understand are left alone, though
+their children are still compiled.
+"""
+
+from rowan.utils.cache import LRUCache
+import base
+import core
+
+def compile_tree(controller):
+    """
+    Returns a controller that behaves the same as the given one. The
+    given tree is not altered: any controller that needs to change is
+    copied, so the original tree can still be used.
+    """
+    return _compile(controller, {})
+
+def _compile(controller, compiled):
+    # Subtrees may be shared, so only compile each controller once.
+    key = id(controller)
+    if key not in compiled:
+        if type(controller) is core.SetParams:
+            result = _compile_set_params(controller, compiled)
+        elif type(controller) is core.Fallback:
+            result = _compile_fallback(controller, compiled)
+        elif core._is_plain_router(controller):
+            result = _compile_router(controller, compiled)
+        elif isinstance(controller, core.Router):
+            result = _compile_router_subclass(controller, compiled)
+        elif isinstance(controller, base.Wrapper):
+            result = _compile_wrapper(controller, compiled)
+        elif isinstance(controller, base.Selector):
+            result = _compile_selector(controller, compiled)
+        else:
+            result = controller
+        compiled[key] = result
+    return compiled[key]
+
+def _clone(controller):
+    """
+    Makes a shallow copy of a controller. This can't use the copy
+    module, because BaseController calls __init__ when it is created.
+    """
+    clone = object.__new__(type(controller))
+    clone.__dict__.update(controller.__dict__)
+    return clone
+
+def _compile_wrapper(wrapper, compiled):
+    child = _compile(wrapper.controller, compiled)
+    if child is wrapper.controller:
+        return wrapper
+    wrapper = _clone(wrapper)
+    wrapper.controller = child
+    return wrapper
+
+def _compile_selector(selector, compiled):
+    children = tuple(
+        _compile(child, compiled) for child in selector.controllers
+        )
+    if all(new is old for new, old in zip(children, selector.controllers)):
+        return selector
+    selector = _clone(selector)
+    selector.controllers = children
+    return selector
+
+def _compile_set_params(set_params, compiled):
+    child = _compile(set_params.controller, compiled)
+
+    # Setting nothing is a no-op.
+    if not set_params.kws:
+        return child
+
+    # Merge directly nested settings into one change of context.
+    if (type(child) is core.SetParams and
+        _can_merge(set_params.kws, child.kws)):
+        kws = dict(set_params.kws)
+        kws.update(child.kws)
+        merged = _clone(set_params)
+        merged.controller = child.controller
+        merged.kws = kws
+        return merged
+
+    if child is set_params.controller:
+        return set_params
+    set_params = _clone(set_params)
+    set_params.controller = child
+    return set_params
+
+def _can_merge(outer_kws, inner_kws):
+    """
+    Settings can be merged unless one sets a nested value inside
+    another (e.g. ``a`` and ``a__b``), because the order the values
+    would then be set in matters.
+    """
+    outer = [tuple(key.split('__')) for key in outer_kws]
+    inner = [tuple(key.split('__')) for key in inner_kws]
+    for a in outer:
+        for b in inner:
+            shorter = min(len(a), len(b))
+            if a != b and a[:shorter] == b[:shorter]:
+                return False
+    return True
+
+def _compile_fallback(fallback, compiled):
+    # A fallback with one option raises whatever its child raises.
+    if len(fallback.controllers) == 1:
+        return _compile(fallback.controllers[0], compiled)
+    return _compile_selector(fallback, compiled)
+
+def _compile_router(router, compiled):
+    mappings = _compile_mappings(router, compiled)
+    router = _copy_router(router, mappings)
+    if router.prefix_index is None:
+        router.prefix_index = core._PrefixIndex([
+            core._literal_prefix(regex) for regex, controller in mappings
+            ])
+    if any(core._is_plain_router(c) for c in router.controllers):
+        router.fold_routers = True
+    return router
+
+def _compile_router_subclass(router, compiled):
+    # Routers that dispatch in their own way can't be indexed or
+    # folded, but their children can still be compiled.
+    mappings = _compile_mappings(router, compiled)
+    if all(new[1] is old[1] for new, old in zip(mappings, router.mappings)):
+        return router
+    return _copy_router(router, mappings)
+
+def _compile_mappings(router, compiled):
+    return [
+        (regex, _compile(controller, compiled))
+        for regex, controller in router.mappings
+        ]
+
+def _copy_router(router, mappings):
+    """Returns a copy of the router, using the given mappings."""
+    router = _clone(router)
+    router.mappings = mappings
+    router.controllers = [controller for regex, controller in mappings]
+    if router.cache is not None:
+        # The cache holds the original, uncompiled, controllers.
+        router.cache = LRUCache(router.cache.max_size)
+    return router
@@ -1,50 +1,407 @@
+from __future__ import with_statement
+import httplib
 import os
-import urllib2
+import socket
+import stat
+import threading
+import time
+import urlparse
 
 import rowan.http as http
+from rowan.utils.cache import LRUCache
 import base
 
 class ProxyServer(base.BaseController):
     """
     A controller that proxies data from a remote url.
+
+    If ``base_url`` is given, the request's path (and query string) is
+    added to it to give the remote url, otherwise the path should be
+    the whole remote url. The remote response's status, content and
+    headers are passed back to the user, and its content is streamed
+    in blocks of ``block_size`` bytes rather than being read into
+    memory. Connections to each remote host are kept open and reused,
+    up to ``max_idle`` per host. Connecting to, and waiting for, the
+    remote server give up after ``timeout`` seconds, with a 504
+    response.
+
+    If ``cache_size`` is given, successful GET responses whose
+    ``Cache-Control`` header gives them a ``max-age`` (and doesn't make
+    them private or uncacheable) are cached for that long, up to a
+    total of ``cache_size`` bytes. Responses over
+    ``cache_max_response_size`` bytes aren't cached.
+    """
+    request_headers = (
+        'HTTP_ACCEPT', 'HTTP_ACCEPT_ENCODING', 'HTTP_ACCEPT_LANGUAGE',
+        'HTTP_USER_AGENT', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE',
+        'HTTP_CACHE_CONTROL', 'CONTENT_TYPE'
+        )
+    """The WSGI environment keys of the headers sent to the remote server."""
+
+    skipped_headers = frozenset([
+        'connection', 'keep-alive', 'proxy-authenticate',
+        'proxy-authorization', 'te', 'trailer', 'trailers',
+        'transfer-encoding', 'upgrade', 'content-type', 'date', 'server'
+        ])
     """
+    Headers from the remote server that aren't passed back: those that
+    only apply to the connection, the content type, which is given to
+    the response separately, and those the WSGI server adds itself.
+    """
+
+    def __init__(self, base_url=None, timeout=10, max_idle=10,
+                 block_size=64*1024, cache_size=0,
+                 cache_max_response_size=1024*1024):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.block_size = block_size
+        self.cache_max_response_size = cache_max_response_size
+        if cache_size:
+            self.cache = LRUCache(cache_size, size_of=_proxy_entry_size)
+        else:
+            self.cache = None
+        # Maps (scheme, host) to a list of idle connections.
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get_url(self, request):
+        """Returns the remote url for the given request."""
+        if self.base_url is None:
+            url = request.path
+        else:
+            url = self.base_url.rstrip('/') + request.path
+        if request.query_raw:
+            url = "%s?%s" % (url, request.query_raw)
+        return url
+
     def __call__(self, request):
-        print request.path
-        req = urllib2.Request(
-            request.path,
-            headers={'X-Forwarded-For':request.REQUEST['REMOTE_ADDR']}
+        url = self.get_url(request)
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if scheme not in ('http', 'https') or not host:
+            raise http.HttpError("Can't proxy %s" % url, 400)
+        if query:
+            path = "%s?%s" % (path, query)
+
+        cacheable = self.cache is not None and request.method == 'GET'
+        if cacheable:
+            cache_key = (url, request.REQUEST.get('HTTP_ACCEPT_ENCODING'))
+            entry = self.cache.get(cache_key)
+            if entry is not None:
+                return _build_proxy_response(entry)
+
+        headers = {}
+        for key in self.request_headers:
+            value = request.REQUEST.get(key)
+            if value is not None:
+                if key.startswith('HTTP_'):
+                    key = key[5:]
+                headers[key.replace('_', '-').title()] = value
+        if cacheable:
+            # A 304 for this user is no use to anyone else.
+            headers.pop('If-None-Match', None)
+            headers.pop('If-Modified-Since', None)
+        forwarded_for = request.REQUEST.get('REMOTE_ADDR')
+        if forwarded_for:
+            headers['X-Forwarded-For'] = forwarded_for
+        body = None
+        if request.method not in ('GET', 'HEAD'):
+            body = request.body_raw
+
+        connection, upstream = self._send(
+            (scheme, host), request.method, path, body, headers
             )
-        response = urllib2.urlopen(req)
-        content = response.read()
-        return http.HttpResponse(
-            content, content_type=response.info().gettype()
+        status_code = upstream.status
+        content_type = upstream.getheader('content-type')
+        # Headers such as Set-Cookie may be repeated, and can't be
+        # joined into one, so each value is passed back separately.
+        response_headers = [
+            (name.title(), value)
+            for name in upstream.msg.keys()
+            if name not in self.skipped_headers
+            for value in upstream.msg.getheaders(name)
+            ]
+
+        if status_code == 304:
+            # There is no content, and so no content type to send.
+            self._read((scheme, host), connection, upstream)
+            return http.Http304(response_headers)
+
+        if cacheable:
+            ttl = self._get_ttl(upstream)
+            if ttl:
+                # Read the whole response, so it can be cached.
+                content = self._read((scheme, host), connection, upstream)
+                age = int(upstream.getheader('age', 0) or 0)
+                entry = (
+                    status_code, content_type,
+                    [(name, value) for name, value in response_headers
+                     if name != 'Age'],
+                    content, time.time() - age
+                    )
+                self.cache.set(cache_key, entry, ttl=ttl)
+                return _build_proxy_response(entry)
+
+        content = self._stream((scheme, host), connection, upstream)
+        response = http.HttpResponse(content, content_type, status_code)
+        response.reason = upstream.reason
+        response.extra_headers.extend(response_headers)
+        return response
+
+    def _get_ttl(self, upstream):
+        """
+        Returns the number of seconds the given remote response can be
+        cached for, or None if it can't be.
+        """
+        if upstream.status != 200 or upstream.getheader('set-cookie'):
+            return None
+        vary = upstream.getheader('vary', '').lower()
+        if vary and vary.replace(' ', '') != 'accept-encoding':
+            return None
+        try:
+            length = int(upstream.getheader('content-length'))
+        except (TypeError, ValueError):
+            return None
+        if length > self.cache_max_response_size:
+            return None
+
+        ttl = None
+        for directive in upstream.getheader('cache-control', '').split(','):
+            name, _, value = directive.strip().lower().partition('=')
+            if name in ('no-store', 'no-cache', 'private'):
+                return None
+            elif name in ('max-age', 's-maxage'):
+                try:
+                    ttl = int(value.strip('"'))
+                except ValueError:
+                    return None
+        if ttl is None:
+            return None
+        try:
+            ttl -= int(upstream.getheader('age', 0) or 0)
+        except ValueError:
+            return None
+        return ttl > 0 and ttl or None
+
+    def _get_connection(self, key):
+        """Returns an idle connection to the given host, or None."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def _send(self, key, method, path, body, headers):
+        """
+        Sends a request to the remote server, returning the connection
+        and the remote response.
+        """
+        scheme, host = key
+        connection = None
+        if method in ('GET', 'HEAD'):
+            connection = self._get_connection(key)
+        if connection is not None:
+            # The server may have closed an idle connection, in which
+            # case we try again on a new one.
+            try:
+                return connection, self._request(
+                    connection, host, method, path, body, headers
+                    )
+            except http.HttpError, e:
+                if e.status_code == 504:
+                    raise
+
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=self.timeout)
+        return connection, self._request(
+            connection, host, method, path, body, headers
             )
 
+    def _request(self, connection, host, method, path, body, headers):
+        try:
+            connection.request(method, path, body, headers)
+            return connection.getresponse()
+        except socket.timeout:
+            connection.close()
+            raise http.HttpError("Timed out waiting for %s" % host, 504)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            raise http.HttpError("Can't reach %s: %s" % (host, e), 502)
+
+    def _release(self, key, connection, upstream):
+        """
+        Returns a connection whose response has been read to the pool,
+        or closes it if it can't be reused.
+        """
+        if upstream.will_close:
+            connection.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _read(self, key, connection, upstream):
+        """Returns the whole content of the remote response."""
+        try:
+            content = upstream.read()
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            raise http.HttpError("Can't read from %s: %s" % (key[1], e), 502)
+        self._release(key, connection, upstream)
+        return content
+
+    def _stream(self, key, connection, upstream):
+        """Yields the content of the remote response in blocks."""
+        complete = False
+        try:
+            while True:
+                block = upstream.read(self.block_size)
+                if not block:
+                    break
+                yield block
+            complete = True
+        finally:
+            if complete:
+                self._release(key, connection, upstream)
+            else:
+                connection.close()
+
+def _proxy_entry_size(entry):
+    return len(entry[3])
+
+def _build_proxy_response(entry):
+    status_code, content_type, headers, content, created = entry
+    response = http.HttpResponse(content, content_type, status_code)
+    response.extra_headers.extend(headers)
+    response.extra_headers.append(('Age', str(int(time.time() - created))))
+    return response
+
 class ContentServer(base.BaseController):
     """A controller that serves content from the disk. This is not
     normally advisable for production use, but can be useful while
-    debugging to have content served correctly."""
+    debugging to have content served correctly.
 
-    def __init__(self, base_path):
+    Responses carry ``ETag`` and ``Last-Modified`` headers, based on
+    the file's modification time and size, and conditional requests
+    for files that haven't changed get a 304 response without the
+    file being read.
+
+    If ``cache_size`` is given, the contents of files up to
+    ``cache_max_file_size`` bytes are cached in memory, up to a total
+    of ``cache_size`` bytes. Cached files are checked against the disk
+    on each request, so changed files are never served stale.
+
+    If ``precompressed`` is true, browsers that accept gzip encoding
+    are sent a gzipped copy of the file, if there is one next to it
+    with a ``.gz`` extension that is at least as new as the file
+    itself. These copies can be made at deployment time with
+    :mod:`rowan.utils.precompress`, so no compression is done while
+    serving."""
+
+    def __init__(self, base_path, cache_size=0, cache_max_file_size=256*1024,
+                 precompressed=False):
         """Creates a new content server for the given base location on
         the hard-drive."""
         self.base_path = base_path
+        self.precompressed = precompressed
+        self.cache_max_file_size = cache_max_file_size
+        if cache_size:
+            self.cache = LRUCache(
+                cache_size, size_of=lambda entry: len(entry[2])
+                )
+        else:
+            self.cache = None
 
     def __call__(self, request):
         """
         Retrieves the content from the disk and sends it right to the
-        client without alteration.
+        client without alteration. Files that aren't cached are
+        streamed, rather than read into memory.
         """
         full_path = os.path.join(self.base_path, request.path)
         extension = request.path.split(".")[-1]
         content_type = MIME_TYPES.get(extension, "text/plain")
 
+        stats = _stat_file(full_path)
+        if stats is None:
+            raise http.Http404()
+
+        headers = []
+        if self.precompressed:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if _accepts_gzip(request):
+                gzip_stats = _stat_file(full_path + '.gz')
+                if (gzip_stats and
+                    int(gzip_stats.st_mtime) >= int(stats.st_mtime)):
+                    full_path += '.gz'
+                    stats = gzip_stats
+                    headers.append(('Content-Encoding', 'gzip'))
+
+        mtime = int(stats.st_mtime)
+        etag = '"%x-%x"' % (mtime, stats.st_size)
+        headers.append(('ETag', etag))
+        headers.append(('Last-Modified', http.http_date(mtime)))
+        if http.is_not_modified(request, etag, mtime):
+            return http.Http304(headers)
+
+        response = self._get_response(full_path, stats, content_type)
+        response.extra_headers.extend(headers)
+        return response
+
+    def _get_response(self, full_path, stats, content_type):
+        """Returns a response containing the given file."""
+        cacheable = (self.cache is not None and
+                     stats.st_size <= self.cache_max_file_size)
+        if cacheable:
+            entry = self.cache.get(full_path)
+            if entry and entry[:2] == (stats.st_mtime, stats.st_size):
+                return http.HttpResponse(entry[2], content_type=content_type)
+
         try:
-            content = open(full_path, 'rb').read()
+            content = open(full_path, 'rb')
         except IOError:
             raise http.Http404()
+
+        if cacheable:
+            try:
+                data = content.read()
+            finally:
+                content.close()
+            self.cache.set(full_path, (stats.st_mtime, stats.st_size, data))
+            return http.HttpResponse(data, content_type=content_type)
         else:
-            return http.HttpResponse(content, content_type=content_type)
+            return http.FileResponse(content, content_type=content_type)
+
+def _stat_file(path):
+    """Returns the stats for the given file, or None if it isn't one."""
+    try:
+        stats = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stats.st_mode):
+        return None
+    return stats
+
+def _accepts_gzip(request):
+    """Checks if the request's Accept-Encoding header allows gzip."""
+    for coding in request.REQUEST.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = coding.split(';')
+        if parts[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
 
 MIME_TYPES = {
     "3gp": "video/3gpp",
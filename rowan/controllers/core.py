@@ -6,8 +6,11 @@ from __future__ import with_statement
 import logging
 import re
 import os
+import sre_constants
+import sre_parse
 
 import rowan.http as http
+from rowan.utils.cache import LRUCache
 import base
 
 class ErrorHandler(base.Wrapper):
@@ -23,6 +26,12 @@ class ErrorHandler(base.Wrapper):
     probably want to render more useful and customized error
     messages. You could do that either by subclassing this class, or
     using a :class:`~rowan.controllers.core.Fallback` controller.
+
+    If the controller returns a streamed response, the first chunk of
+    its content is generated before the response is returned, so
+    errors raised up to that point are handled too. Errors raised
+    after content has started to be sent can't be turned into an
+    error page, and are left for the server to deal with.
     """
     def __init__(self, controller, handle_system_errors=True):
         super(ErrorHandler, self).__init__(controller)
@@ -30,7 +39,10 @@ class ErrorHandler(base.Wrapper):
 
     def __call__(self, request):
         try:
-            return self.controller(request)
+            response = self.controller(request)
+            if getattr(response, 'streaming', False):
+                response.prefetch()
+            return response
         except BaseException, err:
             # Always handle our own errors.
             if isinstance(err, http.HttpError):
@@ -137,50 +149,188 @@ class Router(base.BaseController):
     common prefix (such as a section of the site), followed by another
     listening for individual pages within that section, without having
     the section name repeated for each entry in the second router.
+
+    Takes one possible keyword argument 'compiled'. If true, the
+    literal prefix of each regular expression (e.g. ``/blog/`` in
+    ``^/blog/(?P<slug>\w+)/$``) is indexed in a trie when the router is
+    created, and only the mappings whose prefix matches the path are
+    tried. The first matching mapping still wins, so this gives the
+    same results as the default mode, but routers with many entries
+    no longer have to try every expression in turn.
+
+    A second keyword argument, 'cache_size', turns on a cache of that
+    many resolved paths. Both matches and failures are remembered, so
+    repeated requests for the same path don't run any regular
+    expressions at all. The cache is available as the ``cache``
+    property, which counts its hits and misses.
     """
-    def __init__(self, *mappings):
+    fold_routers = False
+    """
+    If true, routers mapped directly beneath this one are resolved in
+    the same call, so the request context is only changed once. This
+    is switched on by :func:`~rowan.controllers.compiler.compile_tree`.
+    """
+
+    def __init__(self, *mappings, **kwargs):
         self.mappings = [
             (re.compile(re_string), controller)
             for re_string, controller in mappings
             ]
         self.controllers = [controller for regex, controller in mappings]
 
+        if kwargs.get('compiled', False):
+            self.prefix_index = _PrefixIndex([
+                _literal_prefix(regex) for regex, controller in self.mappings
+                ])
+        else:
+            self.prefix_index = None
+
+        cache_size = kwargs.get('cache_size', 0)
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+        else:
+            self.cache = None
+
+    def _resolve(self, path):
+        """
+        Finds the first mapping that matches the given path. Returns a
+        tuple of (controller, args, kws, end), where ``end`` is the
+        index in the path that the match finished at, or None if no
+        mapping matches.
+        """
+        if self.cache is not None:
+            resolved = self.cache.get(path, _NOT_CACHED)
+            if resolved is _NOT_CACHED:
+                resolved = self._resolve_uncached(path)
+                self.cache.set(path, resolved)
+            return resolved
+        return self._resolve_uncached(path)
+
+    def _resolve_uncached(self, path):
+        if self.prefix_index is not None:
+            mappings = self.mappings
+            candidates = [
+                mappings[index]
+                for index in self.prefix_index.candidates(path)
+                ]
+        else:
+            candidates = self.mappings
+
+        for regex, controller in candidates:
+            match = regex.match(path)
+            if match is not None:
+                return controller, match.groups(), match.groupdict(), \
+                    match.end()
+        return None
+
     def __call__(self, request):
         self.get_logger().debug("Routing path: %s" % request.path)
-        for regex, controller in self.mappings:
-            match = regex.match(request.path)
-            if match is not None:
-                # Find the match parameters and update the request
-                context_update = {}
-                args = match.groups()
-                kws = match.groupdict()
-
-                if not hasattr(request, 'router_args'):
-                    context_update['router_args'] = args
-                else:
-                    context_update['router_args'] = request.router_args + args
-                if not hasattr(request, 'router_kws'):
-                    context_update['router_kws'] = kws
-                else:
-                    d = dict(**request.router_kws)
-                    d.update(kws)
-                    context_update['router_kws'] = d
-
-                # Update the path
-                try:
-                    context_update['path_stack'] = \
-                        request.path_stack + [request.path]
-                except AttributeError:
-                    context_update['path_stack'] = [request.path]
-                context_update['path'] = request.path[match.end():]
-
-                # Change the context for our children only
-                with request.set(**context_update):
-                    return controller(request)
-
-        raise http.Http404("No matching URL found.")
+
+        # Find the controller, following any directly nested routers
+        # if we're allowed to fold them into this one.
+        path = request.path
+        args = ()
+        kws = {}
+        paths = []
+        router = self
+        while True:
+            resolved = router._resolve(path)
+            if resolved is None:
+                raise http.Http404("No matching URL found.")
+            controller, match_args, match_kws, end = resolved
+            args += match_args
+            kws.update(match_kws)
+            paths.append(path)
+            path = path[end:]
+            if not (self.fold_routers and _is_plain_router(controller)):
+                break
+            router = controller
+
+        # Find the match parameters and update the request
+        context_update = {}
+        if not hasattr(request, 'router_args'):
+            context_update['router_args'] = args
+        else:
+            context_update['router_args'] = request.router_args + args
+        if not hasattr(request, 'router_kws'):
+            context_update['router_kws'] = kws
+        else:
+            d = dict(**request.router_kws)
+            d.update(kws)
+            context_update['router_kws'] = d
+
+        # Update the path
+        try:
+            context_update['path_stack'] = request.path_stack + paths
+        except AttributeError:
+            context_update['path_stack'] = paths
+        context_update['path'] = path
+
+        # Change the context for our children only
+        with request.set(**context_update):
+            return controller(request)
 
     def get_children(self):
-        return [self.controllers]
+        return self.controllers
 
+def _is_plain_router(controller):
+    """
+    Checks if the given controller is a router that dispatches in the
+    standard way, so it can be folded into the router above it.
+    """
+    return (isinstance(controller, Router) and
+            type(controller).__call__.__func__ is Router.__call__.__func__)
 
+_NOT_CACHED = object()
+
+def _literal_prefix(regex):
+    """
+    Returns the literal text that any string matched by the given
+    compiled regular expression must start with. This is empty if the
+    expression starts with anything other than plain characters, or
+    if it is matched case-insensitively.
+    """
+    if regex.flags & (re.IGNORECASE | re.LOCALE):
+        return ''
+
+    prefix = []
+    for op, arg in sre_parse.parse(regex.pattern, regex.flags):
+        if op == sre_constants.AT and not prefix and arg in (
+            sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING
+            ):
+            continue
+        elif op == sre_constants.LITERAL and arg < 128:
+            prefix.append(chr(arg))
+        else:
+            break
+    return ''.join(prefix)
+
+class _PrefixIndex(object):
+    """
+    A trie of literal prefixes, used by compiled routers to find the
+    mappings that could possibly match a path, in their original order.
+    """
+    def __init__(self, prefixes):
+        # Each node is a pair of (children by character, mapping indices).
+        self.root = ({}, [])
+        for index, prefix in enumerate(prefixes):
+            children, indices = self.root
+            for char in prefix:
+                children, indices = children.setdefault(char, ({}, []))
+            indices.append(index)
+
+    def candidates(self, path):
+        """
+        Returns the indices of the mappings whose prefix the given
+        path starts with, in ascending order.
+        """
+        children, indices = self.root
+        found = list(indices)
+        for char in path:
+            try:
+                children, indices = children[char]
+            except KeyError:
+                break
+            found.extend(indices)
+        found.sort()
+        return found
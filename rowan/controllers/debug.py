@@ -13,6 +13,11 @@ class JSONViewer(base.Wrapper):
     HTTP response code, then it will render the result into HTML and
     return a HTML response. Any other response passes through
     untouched.
+
+    A :class:`~rowan.http.JSONResponse` is rendered from the data it
+    was created with, rather than by parsing the JSON it generated,
+    unless the data holds iterables (such as generators) that encoding
+    it may have used up.
     """
 
     def __call__(self, request):
@@ -21,67 +26,104 @@ class JSONViewer(base.Wrapper):
             response.content_type != "application/json"):
             return response
 
-        # Parse the json
-        json_data = json.loads(response.content)
+        if (isinstance(response, http.JSONResponse) and
+            _is_reusable(response.json_data)):
+            json_data = response.json_data
+            convert = response.convert
+        else:
+            # Parse the json
+            json_data = json.loads(response.content)
+            convert = str
 
         # Create the HTML response
-        response = http.HttpResponse(content_type = "text/html")
-        response.write(before)
-        self._output(response, json_data)
-        response.write(after)
-        return response
-
-    def _output(self, response, data):
-        if isinstance(data, list):
-            self._output_array(response, data)
+        chunks = [before]
+        self._output(chunks, json_data, convert)
+        chunks.append(after)
+        return http.HttpResponse(''.join(chunks), content_type="text/html")
+
+    def _output(self, chunks, data, convert):
+        if isinstance(data, (list, tuple)):
+            self._output_array(chunks, data, convert)
         elif isinstance(data, dict):
-            self._output_object(response, data)
-        elif data in (True, False):
-            self._output_boolean(response, data)
+            self._output_object(chunks, data, convert)
+        elif isinstance(data, bool):
+            self._output_boolean(chunks, data)
         elif isinstance(data, basestring):
-            self._output_string(response, data)
+            self._output_string(chunks, data)
+        elif data is None or isinstance(data, (int, long, float)):
+            self._output_number(chunks, data)
         else:
-            self._output_number(response, data)
+            # Show what would have been sent as JSON.
+            self._output(chunks, convert(data), convert)
 
-    def _output_boolean(self, response, boolean):
-        response.write("<div class='boolean'>%s</div>" % str(boolean).lower())
+    def _output_boolean(self, chunks, boolean):
+        chunks.append("<div class='boolean'>%s</div>" % str(boolean).lower())
 
-    def _output_string(self, response, literal):
-        response.write(
-            "<div class='string'>\"%s\"</div>" % cgi.escape(literal)
+    def _output_string(self, chunks, literal):
+        chunks.append(
+            "<div class='string'>\"%s\"</div>" % _escape(literal)
             )
 
-    def _output_number(self, response, literal):
-        response.write("<div class='number'>%s</div>" % str(literal))
-
-    def _output_object(self, response, obj):
-        response.write("<div class='object'>")
-        count = len(obj)
-        if count:
-            response.write("<table>")
-            for key, value in sorted(obj.items()):
-                response.write("<tr><th>%s:</th><td>" % cgi.escape(key))
-                self._output(response, value)
-                response.write("</td></tr>")
-            response.write("</table>")
+    def _output_number(self, chunks, literal):
+        chunks.append("<div class='number'>%s</div>" % str(literal))
+
+    def _output_object(self, chunks, obj, convert):
+        chunks.append("<div class='object'>")
+        if obj:
+            chunks.append("<table>")
+            items = sorted(
+                ((_key_string(key), value) for key, value in obj.items()),
+                key=lambda item: item[0]
+                )
+            for key, value in items:
+                chunks.append("<tr><th>%s:</th><td>" % _escape(key))
+                self._output(chunks, value, convert)
+                chunks.append("</td></tr>")
+            chunks.append("</table>")
         else:
-            response.write("{}")
+            chunks.append("{}")
 
-        response.write("</div>")
+        chunks.append("</div>")
 
-    def _output_array(self, response, seq):
-        response.write("<div class='array'>")
-        count = len(seq)
-        if count:
-            response.write("<table>")
+    def _output_array(self, chunks, seq, convert):
+        chunks.append("<div class='array'>")
+        if seq:
+            chunks.append("<table>")
             for i, item in enumerate(seq):
-                response.write("<tr><th>%d</th><td>" % i)
-                self._output(response, item)
-                response.write("</td></tr>")
-            response.write("</table>")
+                chunks.append("<tr><th>%d</th><td>" % i)
+                self._output(chunks, item, convert)
+                chunks.append("</td></tr>")
+            chunks.append("</table>")
         else:
-            response.write("[]")
-        response.write("</div>")
+            chunks.append("[]")
+        chunks.append("</div>")
+
+def _is_reusable(data):
+    """
+    Checks that the given data can be rendered after it has been
+    encoded: that it holds no iterables that may only be iterated once.
+    """
+    if isinstance(data, (list, tuple)):
+        return all(_is_reusable(item) for item in data)
+    elif isinstance(data, dict):
+        return all(_is_reusable(value) for value in data.itervalues())
+    elif isinstance(data, (basestring, set, frozenset)):
+        return True
+    else:
+        return not hasattr(data, '__iter__')
+
+def _escape(text):
+    """Escapes text for HTML, returning a UTF-8 encoded string."""
+    text = cgi.escape(text)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return text
+
+def _key_string(key):
+    """Returns the given key as it would be written in JSON."""
+    if isinstance(key, basestring):
+        return key
+    return json.dumps(key)
 
 class OptionalJSONViewer(JSONViewer):
     """
@@ -1,42 +1,74 @@
 from time import time
+import copy
 import urlparse
 import uuid
+import weakref
 
 import base
+from rowan.utils.cache import LRUCache
 from rowan.utils.subdicts import ChangeTrackingDict
 import rowan.http as http
+import rowan.sessions as sessions
+
+# Cached in place of the data for keys that aren't valid.
+_INVALID_KEY = object()
+
+_MISSING = object()
 
 class SessionMiddleware(base.Wrapper):
     """
     Wraps another controller, doing the session lookup before
-    delegating. The database middleware must be called before this.
+    delegating. Sessions are loaded and saved by a session store (see
+    :mod:`rowan.sessions`). By default they are kept in the mongo
+    database, in which case the database middleware must be called
+    before this.
+
+    The session is given to the controller as a
+    :class:`~rowan.utils.subdicts.ChangeTrackingDict`. Afterwards, the
+    whole session is only saved if it has changed.
+
+    Sessions expire ``ttl`` seconds after they were last saved, but
+    extending the expiry on every request would mean a write for every
+    request. Instead, the expiry of an unchanged session is only
+    extended once less than ``refresh_threshold`` (a fraction of the
+    ``ttl``) of its lifetime remains. The middleware counts the number
+    of ``saves`` and expiry ``refreshes`` it makes, and the number of
+    ``skipped_writes`` it avoided.
     """
-    def __call__(self, request):
-        assert request.db, "Create a database before using sessions."
+    def __init__(self, controller, store=None, ttl=3600,
+                 refresh_threshold=0.5):
+        super(SessionMiddleware, self).__init__(controller)
+        if store is None:
+            store = sessions.MongoSessionStore()
+        self.store = store
+        self.ttl = ttl
+        self.refresh_threshold = refresh_threshold
 
+        # Statistics
+        self.saves = 0
+        self.refreshes = 0
+        self.skipped_writes = 0
+
+    def __call__(self, request):
         # Assume we need a new session unless we find otherwise.
-        create_cookie = False
         make_new_session = True
+        ip = request.REQUEST.get("REMOTE_ADDR")
 
-        # See if we have a current session id.
-        session_id = request.cookies.get('session')
-        if session_id:
+        # See if we have a current session.
+        cookie_value = request.cookies.get('session')
+        if cookie_value:
 
             # Look up the session
-            session_data = request.db.mongo.session.find_one(
-                {"id": session_id}
-                )
+            session_data = self.store.load(request, cookie_value)
             if session_data:
                 assert session_data['type'] == "session"
 
-                ip = request.REQUEST["REMOTE_ADDR"]
-
                 # Time-out sessions, and check for IP-hacking.
                 if session_data['expires'] < time():
                     self.get_logger().warning("Expired session from %s" % ip)
                     session_data = None
 
-                elif session_data['ip'] != request.REQUEST["REMOTE_ADDR"]:
+                elif session_data['ip'] != ip:
                     self.get_logger().warning("Mismatched IP from %s" % ip)
                     session_data = None
 
@@ -51,35 +83,129 @@ class SessionMiddleware(base.Wrapper):
             # Create a session, we know we have no user.
             session_id = str(uuid.uuid4())
             request.session_info = session_id
-            create_cookie = True
 
             # Configure the session object for the database
             session_data = {
                 "id": session_id,
                 "type": "session",
-                "ip": request.REQUEST.get("REMOTE_ADDR"),
-                "expires": time() + 3600
+                "ip": ip,
+                "expires": time() + self.ttl
                 }
+        session = ChangeTrackingDict(session_data)
 
-        # Delegate to generate the result, then add session tracking.
-        with request.set(session=session_data):
+        # Delegate to generate the result.
+        with request.set(session=session):
             result = self.controller(request)
 
-        # Add a cookie if we need to track a new or changed session.
-        if create_cookie: result.set_cookie('session', session_id)
+        # Finally save the session if it has changed, or refresh its
+        # expiry if it is getting old. Changing only the expiry
+        # doesn't count as changing the session's data.
+        now = time()
+        if make_new_session or session.dirty:
+            dict.__setitem__(session, 'expires', now + self.ttl)
+            new_cookie_value = self.store.save(request, session)
+            self.saves += 1
+        elif session['expires'] - now < self.ttl * self.refresh_threshold:
+            dict.__setitem__(session, 'expires', now + self.ttl)
+            new_cookie_value = self.store.touch(request, session)
+            self.refreshes += 1
+        else:
+            new_cookie_value = cookie_value
+            self.skipped_writes += 1
+        session.clean()
 
-        # Finally save the session (this needs to be done always, to
-        # keep the expiry up to date).
-        session_data['expires'] = time() + 3600
-        request.db.mongo.session.save(session_data)
+        # Add a cookie if we need to track a new or changed session.
+        if new_cookie_value != cookie_value:
+            result.set_cookie('session', new_cookie_value)
 
         return result
 
+class SignedCookieSessionMiddleware(SessionMiddleware):
+    """
+    A session middleware that keeps the session in a signed cookie,
+    rather than the database, so no database lookups are needed. See
+    :class:`~rowan.sessions.SignedCookieSessionStore` for the meaning
+    of the arguments, and its limitations.
+    """
+    def __init__(self, controller, secret_keys, compress=True,
+                 max_size=4000, **kws):
+        store = sessions.SignedCookieSessionStore(
+            secret_keys, compress=compress, max_size=max_size
+            )
+        super(SignedCookieSessionMiddleware, self).__init__(
+            controller, store=store, **kws
+            )
+
 class UserMiddleware(base.Wrapper):
     """
     Wraps another controller, doing the user object lookup - the
     session MUST be set-up before this is called.
+
+    Changed users are saved at the end of the request. Each save
+    increments the ``version`` field of the user object, and only
+    succeeds if the version in the database is still the one that was
+    loaded. If the user was saved elsewhere in the meantime, the
+    current user object is loaded, this request's changes are applied
+    to it, and the save is tried again (up to ``save_attempts`` times),
+    so changes made elsewhere are never overwritten.
+
+    If ``cache_size`` is given, up to that many user objects are
+    cached in this process for ``cache_ttl`` seconds, so most requests
+    don't need to look their user up. Code in this process that saves
+    users directly should call :meth:`invalidate` afterwards. Other
+    processes can't update our cache, so if ``check_version`` is true,
+    each cached user's version is checked against the database (a
+    lookup of that one field) before it is used, and out of date users
+    are reloaded.
     """
+    save_attempts = 3
+
+    # The instances with caches, so they can all be invalidated.
+    _cached_instances = weakref.WeakSet()
+
+    def __init__(self, controller, cache_size=0, cache_ttl=60,
+                 check_version=False):
+        super(UserMiddleware, self).__init__(controller)
+        self.check_version = check_version
+        if cache_size:
+            self.cache = LRUCache(cache_size, ttl=cache_ttl)
+            UserMiddleware._cached_instances.add(self)
+        else:
+            self.cache = None
+
+    @classmethod
+    def invalidate(cls, user_id):
+        """
+        Removes the given user from the caches of every user middleware
+        in this process, so it is loaded again when next used.
+        """
+        for instance in list(cls._cached_instances):
+            instance.cache.delete(user_id)
+
+    def _find_user(self, request, user_id):
+        """Returns the user object with the given id, or None."""
+        users = request.db.mongo.user
+        if self.cache is None:
+            return users.find_one({"id":user_id})
+
+        user_obj = self.cache.get(user_id)
+        if user_obj is not None and self.check_version:
+            current = users.find_one({"id":user_id}, ["version"])
+            if current is None:
+                self.cache.delete(user_id)
+                return None
+            elif current.get('version') != user_obj.get('version'):
+                user_obj = None
+
+        if user_obj is None:
+            user_obj = users.find_one({"id":user_id})
+            if user_obj:
+                self.cache.set(user_id, copy.deepcopy(user_obj))
+            return user_obj
+        else:
+            # Copied, so changes don't alter the cache until saved.
+            return copy.deepcopy(user_obj)
+
     def __call__(self, request):
         assert request.session, "Create a session before dealing with users."
 
@@ -91,11 +217,12 @@ class UserMiddleware(base.Wrapper):
         user_obj = None
         if user_id:
             # Get the user object associated with this session.
-            user_obj = request.db.mongo.user.find_one({"id":user_id})
+            user_obj = self._find_user(request, user_id)
             if not user_obj:
                 # We had a user-id but it is not valid, so remove it.
                 del request.session['user_id']
             else:
+                loaded = copy.deepcopy(user_obj)
                 user_obj = ChangeTrackingDict(user_obj)
 
         # Delegate to generate the result.
@@ -104,16 +231,96 @@ class UserMiddleware(base.Wrapper):
 
         # Save if modified
         if user_obj and user_obj.dirty:
-            request.db.mongo.user.save(user_obj)
+            self._save_user(request, user_id, user_obj, loaded)
             user_obj.clean()
 
         return result
 
+    def _save_user(self, request, user_id, user_obj, loaded):
+        """
+        Saves the changes made to a user object, which was ``loaded``
+        before it was changed, without overwriting changes saved since.
+        """
+        users = request.db.mongo.user
+        data = dict(user_obj)
+        for attempt in range(self.save_attempts):
+            version = loaded.get('version')
+            data['version'] = (version or 0) + 1
+            if users.find_and_modify({"id":user_id, "version":version}, data):
+                if self.cache is not None:
+                    self.cache.set(user_id, copy.deepcopy(data))
+                return
+
+            # Saved elsewhere, so apply our changes to the current user.
+            if self.cache is not None:
+                self.cache.delete(user_id)
+            current = users.find_one({"id":user_id})
+            if current is None:
+                self.get_logger().warning("User %s was removed." % user_id)
+                return
+            changed = dict(
+                (key, value) for key, value in user_obj.iteritems()
+                if key != 'version' and loaded.get(key, _MISSING) != value
+                )
+            removed = [key for key in loaded if key not in user_obj]
+            data = dict(current)
+            data.update(changed)
+            for key in removed:
+                data.pop(key, None)
+            loaded = current
+
+        self.get_logger().error(
+            "Changes to user %s were not saved, because it kept changing."
+            % user_id
+            )
+
 class APIKeyMiddleware(base.Wrapper):
     """
     Wraps another controller, making sure any incoming requests have a
     valid API key for the associated location.
+
+    If ``cache_size`` is given, the results of looking up up to that
+    many (key, domain) pairs are cached in this process, so most calls
+    don't need the database. Valid keys are cached for ``cache_ttl``
+    seconds, and invalid keys for ``invalid_ttl`` seconds, so repeated
+    calls with a bad key don't reach the database either. The cache's
+    ``hits``, ``misses`` and ``hit_rate`` show how well it is working.
     """
+    def __init__(self, controller, cache_size=0, cache_ttl=60,
+                 invalid_ttl=10):
+        super(APIKeyMiddleware, self).__init__(controller)
+        self.invalid_ttl = invalid_ttl
+        if cache_size:
+            self.cache = LRUCache(cache_size, ttl=cache_ttl)
+        else:
+            self.cache = None
+
+    def _find_api(self, request, api_key, domain):
+        """
+        Returns the api data for the given key, if it is valid for the
+        given domain, or None.
+        """
+        if self.cache is None:
+            return request.db.mongo.api.find_one(
+                {"id": api_key, "domains": domain}
+                )
+
+        cache_key = (api_key, domain)
+        api_data = self.cache.get(cache_key)
+        if api_data is None:
+            api_data = request.db.mongo.api.find_one(
+                {"id": api_key, "domains": domain}
+                )
+            if api_data:
+                self.cache.set(cache_key, copy.deepcopy(api_data))
+            else:
+                self.cache.set(cache_key, _INVALID_KEY, ttl=self.invalid_ttl)
+            return api_data
+        elif api_data is _INVALID_KEY:
+            return None
+        else:
+            return copy.deepcopy(api_data)
+
     def __call__(self, request):
         assert request.db, "Create a database before checking for the API key."
 
@@ -130,13 +337,15 @@ class APIKeyMiddleware(base.Wrapper):
             # from the correct place.
             from_location = request.body_params.get('from')
             if from_location:
-                from_location_domain = urlparse.urlparse(from_location).netloc
+                from_location_domain = urlparse.urlparse(
+                    from_location[0].strip()
+                    ).netloc
 
-                # Find the api key in the database matching the given
-                # domain. So we can fail by either not having the key, or
-                # not having the domain.
-                api_data = request.db.mongo.api.find_one(
-                    {"id": api_key, "domains": from_location_domain}
+                # Find the api key matching the given domain. So we
+                # can fail by either not having the key, or not having
+                # the domain.
+                api_data = self._find_api(
+                    request, api_key, from_location_domain
                     )
                 if api_data:
                     assert api_data['type'] == "api"
@@ -148,8 +357,15 @@ class APIKeyMiddleware(base.Wrapper):
 
                     # Save the api data if we need to.
                     if request.api.dirty:
-                        request.db.mongo.api.save(request['api'])
-                        request.api.save()
+                        request.db.mongo.api.save(request.api)
+                        request.api.clean()
+                        if self.cache is not None:
+                            # Copies cached for other domains stay
+                            # out of date until they expire.
+                            self.cache.set(
+                                (api_key, from_location_domain),
+                                copy.deepcopy(dict(request.api))
+                                )
 
                     return result
                 else:
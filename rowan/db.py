@@ -1,4 +1,10 @@
+import os
+import re
+import threading
+import time
+
 import rowan.controllers.base as base
+import rowan.http as http
 
 # ----------------------------------------------------------------------------
 
@@ -7,6 +13,9 @@ class MongoDBMiddleware(base.Wrapper):
     Wraps another controller, setting up the mongo database before
     delegation. The database is housed in the .db.mongo property of the
     request.
+
+    If ``instrument`` is true, the queries made through the database
+    are recorded by :class:`QueryStatsMiddleware`.
     """
     @classmethod
     def import_dependencies(cls):
@@ -14,23 +23,43 @@ class MongoDBMiddleware(base.Wrapper):
         import pymongo
 
     def __init__(self, controller,
-                 server="localhost", port=27017, db="test"):
+                 server="localhost", port=27017, db="test", instrument=False):
         super(MongoDBMiddleware, self).__init__(controller)
         self.server = server
         self.port = port
         self.db = db
+        self.instrument = instrument
         self.connection = pymongo.Connection(self.server, self.port)
 
     def __call__(self, request):
-        with request.set(db__mongo=self.connection[self.db]):
+        database = self.connection[self.db]
+        if self.instrument:
+            database = InstrumentedMongoDatabase(database)
+        with request.set(db__mongo=database):
             return self.controller(request)
 
 # ----------------------------------------------------------------------------
 
 class SQLAlchemyMiddleware(base.Wrapper):
     """Wraps another controller, setting up the sql database before
-    delegation. The database is housed in the .db.sqlalechmy property of
+    delegation. The database is housed in the .db.sqlalchemy property of
     the request.
+
+    Each request gets its own session, which is committed when the
+    wrapped controller returns, rolled back if it raises, and then
+    closed, returning its connection to the pool. If the response is
+    streamed (and isn't a file), the session is only committed and
+    closed once all its content has been sent, so the content can
+    still use it. The engine (and so its connection pool) is created
+    when the first request arrives, and shared by every request in the
+    process. Connections can't be shared between processes, so a
+    forked process creates its own.
+
+    ``pool_size``, ``max_overflow``, ``pool_recycle`` and
+    ``pool_pre_ping`` configure the connection pool; any other keyword
+    arguments are passed on to ``create_engine``. Set ``echo`` to log
+    every statement. If ``instrument`` is true, the statements run by
+    the engine are recorded by :class:`QueryStatsMiddleware`.
     """
     @classmethod
     def import_dependencies(cls):
@@ -38,12 +67,256 @@ class SQLAlchemyMiddleware(base.Wrapper):
         import sqlalchemy as sql
         import sqlalchemy.orm as orm
 
-    def __init__(self, controller, connection_string="sqlite:///database.db"):
+    def __init__(self, controller, connection_string="sqlite:///database.db",
+                 echo=False, pool_size=5, max_overflow=10, pool_recycle=3600,
+                 pool_pre_ping=False, instrument=False, **engine_kws):
         super(SQLAlchemyMiddleware, self).__init__(controller)
         self.connection_string = connection_string
+        self.instrument = instrument
+        self.engine_kws = dict(engine_kws, echo=echo, pool_recycle=pool_recycle)
+        if not connection_string.startswith('sqlite'):
+            # SQLite uses its own pools, which can't be sized.
+            self.engine_kws.update(
+                pool_size=pool_size, max_overflow=max_overflow
+                )
+        if pool_pre_ping:
+            self.engine_kws['pool_pre_ping'] = True
+        self.engine = None
+        self.session_factory = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_session_factory(self):
+        """
+        Returns the factory for sessions bound to this process's engine,
+        creating the engine if needed.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self.engine = sql.create_engine(
+                        self.connection_string, **self.engine_kws
+                        )
+                    if self.instrument:
+                        _instrument_engine(self.engine)
+                    self.session_factory = orm.sessionmaker(bind=self.engine)
+                    self._pid = pid
+        return self.session_factory
 
     def __call__(self, request):
-        engine = sql.create_engine(self.connection_string, echo=True)
-        with request.set(db__sqlalchemy=orm.sessionmaker(bind=engine)()):
-            return self.controller(request)
+        session = self.get_session_factory()()
+        try:
+            with request.set(db__sqlalchemy=session):
+                result = self.controller(request)
+        except:
+            session.rollback()
+            session.close()
+            raise
+
+        if result.streaming and not isinstance(result, http.FileResponse):
+            # The content may still load data through the session.
+            result.call_on_close(
+                lambda finished: _end_session(session, finished)
+                )
+        else:
+            _end_session(session, True)
+        return result
+
+def _end_session(session, commit):
+    """
+    Commits the given session if ``commit`` is true, or rolls it back
+    otherwise, then closes it.
+    """
+    try:
+        if commit:
+            session.commit()
+        else:
+            session.rollback()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _instrument_engine(engine):
+    """Records the statements the given engine runs in the query stats."""
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context, executemany):
+        context._rowan_start_time = time.time()
+
+    def after_cursor_execute(conn, cursor, statement, parameters,
+                             context, executemany):
+        record_query(
+            _normalize_statement(statement),
+            time.time() - context._rowan_start_time
+            )
+
+    sql.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sql.event.listen(engine, "after_cursor_execute", after_cursor_execute)
 
+_whitespace = re.compile(r'\s+')
+
+def _normalize_statement(statement):
+    # SQLAlchemy passes values as parameters, so the statement is
+    # already the shape of the query.
+    return _whitespace.sub(' ', statement).strip()
+
+# ----------------------------------------------------------------------------
+
+class QueryStats(object):
+    """
+    Counts the database queries made while handling one request, and
+    the total time they took. Queries are grouped by their
+    fingerprint: the shape of the query without its values, so
+    repeating the same query for different values (the "N+1 queries"
+    problem) can be spotted.
+    """
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.fingerprints = {}
+
+    def record(self, fingerprint, duration):
+        self.count += 1
+        self.time += duration
+        self.fingerprints[fingerprint] = \
+            self.fingerprints.get(fingerprint, 0) + 1
+
+    def repeated(self, threshold):
+        """
+        Returns (fingerprint, count) pairs for the queries made more
+        than ``threshold`` times, most repeated first.
+        """
+        return sorted(
+            [(fingerprint, count)
+             for fingerprint, count in self.fingerprints.iteritems()
+             if count > threshold],
+            key=lambda pair: -pair[1]
+            )
+
+# The database libraries don't know about requests, so the stats for
+# the request being handled by each thread are kept here.
+_local = threading.local()
+
+def record_query(fingerprint, duration):
+    """
+    Records a query in the stats of the current request, if they are
+    being collected.
+    """
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.record(fingerprint, duration)
+
+class QueryStatsMiddleware(base.Wrapper):
+    """
+    Wraps another controller, recording the database queries it makes.
+    Only databases set up with ``instrument=True`` are recorded. The
+    :class:`QueryStats` are available in the .db.stats property of the
+    request.
+
+    A warning is logged when a query with the same fingerprint is made
+    more than ``repeat_threshold`` times in one request. If ``debug``
+    is true, the stats are also sent in an X-DB-Queries response
+    header. Queries made while a streamed response is being sent
+    happen after the headers, so they are not included.
+    """
+    def __init__(self, controller, repeat_threshold=10, debug=False):
+        super(QueryStatsMiddleware, self).__init__(controller)
+        self.repeat_threshold = repeat_threshold
+        self.debug = debug
+
+    def __call__(self, request):
+        stats = QueryStats()
+        previous = getattr(_local, 'stats', None)
+        _local.stats = stats
+        try:
+            with request.set(db__stats=stats):
+                response = self.controller(request)
+        finally:
+            _local.stats = previous
+            for fingerprint, count in stats.repeated(self.repeat_threshold):
+                self.get_logger().warning(
+                    "Query made %d times for %s: %s" % (
+                        count, request.path, fingerprint
+                        )
+                    )
+
+        if self.debug:
+            response.extra_headers.append((
+                'X-DB-Queries', "count=%d; time=%.1fms; repeated=%d" % (
+                    stats.count, stats.time*1000,
+                    len(stats.repeated(self.repeat_threshold))
+                    )
+                ))
+        return response
+
+# ----------------------------------------------------------------------------
+
+class InstrumentedMongoDatabase(object):
+    """
+    Wraps a pymongo database, recording the queries made through its
+    collections. Anything other than getting a collection is passed
+    straight to the database.
+    """
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return InstrumentedMongoCollection(self._database[name], name)
+
+    def __getattr__(self, name):
+        import pymongo.collection
+        attribute = getattr(self._database, name)
+        if isinstance(attribute, pymongo.collection.Collection):
+            return InstrumentedMongoCollection(attribute, name)
+        return attribute
+
+class InstrumentedMongoCollection(object):
+    """
+    Wraps a pymongo collection, recording calls to its query methods.
+    Calls to ``find`` only create a cursor, so they are counted, but
+    the time spent fetching results isn't.
+    """
+    query_methods = frozenset([
+        'find', 'find_one', 'find_and_modify', 'count', 'distinct',
+        'aggregate', 'group', 'map_reduce', 'insert', 'save', 'update',
+        'remove'
+        ])
+
+    def __init__(self, collection, name):
+        self._collection = collection
+        self._name = name
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in self.query_methods:
+            return attribute
+
+        def _recorded(*args, **kws):
+            start = time.time()
+            try:
+                return attribute(*args, **kws)
+            finally:
+                spec = args[0] if args else kws.get('spec')
+                record_query(
+                    "%s.%s(%s)" % (self._name, name, _shape(spec)),
+                    time.time() - start
+                    )
+        return _recorded
+
+def _shape(value):
+    """
+    Returns the shape of a mongo query or document: its keys and
+    operators, with every value replaced by '?'.
+    """
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(
+            "%s: %s" % (key, _shape(value[key])) for key in sorted(value)
+            )
+    elif isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(sorted(set(_shape(v) for v in value)))
+    elif value is None:
+        return ""
+    else:
+        return "?"
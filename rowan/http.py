@@ -9,8 +9,11 @@ from cStringIO import StringIO
 from cgi import escape
 from urlparse import parse_qs
 from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_tz, mktime_tz
 import json
+import os
 import re
+import tempfile
 
 import rowan.utils.blackboard as blackboard
 from rowan.utils.subdicts import MultipleSourceDict
@@ -18,6 +21,7 @@ from rowan.utils.subdicts import MultipleSourceDict
 HTTP_STATUS_CODES = {
     100: 'CONTINUE',
     101: 'SWITCHING PROTOCOLS',
+    102: 'PROCESSING',
     200: 'OK',
     201: 'CREATED',
     202: 'ACCEPTED',
@@ -25,6 +29,8 @@ HTTP_STATUS_CODES = {
     204: 'NO CONTENT',
     205: 'RESET CONTENT',
     206: 'PARTIAL CONTENT',
+    207: 'MULTI-STATUS',
+    226: 'IM USED',
     300: 'MULTIPLE CHOICES',
     301: 'MOVED PERMANENTLY',
     302: 'FOUND',
@@ -33,6 +39,7 @@ HTTP_STATUS_CODES = {
     305: 'USE PROXY',
     306: 'RESERVED',
     307: 'TEMPORARY REDIRECT',
+    308: 'PERMANENT REDIRECT',
     400: 'BAD REQUEST',
     401: 'UNAUTHORIZED',
     402: 'PAYMENT REQUIRED',
@@ -51,18 +58,83 @@ HTTP_STATUS_CODES = {
     415: 'UNSUPPORTED MEDIA TYPE',
     416: 'REQUESTED RANGE NOT SATISFIABLE',
     417: 'EXPECTATION FAILED',
+    422: 'UNPROCESSABLE ENTITY',
+    423: 'LOCKED',
+    424: 'FAILED DEPENDENCY',
+    426: 'UPGRADE REQUIRED',
+    428: 'PRECONDITION REQUIRED',
+    429: 'TOO MANY REQUESTS',
+    431: 'REQUEST HEADER FIELDS TOO LARGE',
     500: 'INTERNAL SERVER ERROR',
     501: 'NOT IMPLEMENTED',
     502: 'BAD GATEWAY',
     503: 'SERVICE UNAVAILABLE',
     504: 'GATEWAY TIMEOUT',
     505: 'HTTP VERSION NOT SUPPORTED',
+    507: 'INSUFFICIENT STORAGE',
+    511: 'NETWORK AUTHENTICATION REQUIRED',
 }
 """
 A dictionary mapping the HTTP response code to a simple human readable
 description, in English.
 """
 
+def http_date(timestamp):
+    """
+    Formats the given timestamp (in seconds since the epoch) as a date
+    suitable for HTTP headers.
+    """
+    return formatdate(timestamp, usegmt=True)
+
+def parse_http_date(value):
+    """
+    Returns the timestamp for the given HTTP header date, or None if
+    it can't be parsed.
+    """
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    Checks the conditional headers of a GET request against the
+    current ``etag`` and ``last_modified`` timestamp of the document
+    it asks for, returning True if the user's cached copy is still
+    valid. If the request gives an ``If-None-Match`` header, then
+    ``If-Modified-Since`` is ignored.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    if_none_match = request.REQUEST.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # Cached copies only need to match weakly.
+        etag = _strip_weak(etag)
+        for candidate in if_none_match.split(','):
+            if _strip_weak(candidate.strip()) == etag:
+                return True
+        return False
+
+    if_modified_since = request.REQUEST.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        return since is not None and int(last_modified) <= since
+
+    return False
+
+def _strip_weak(etag):
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
 class HttpRequest(blackboard.Blackboard):
     """
     Encapsulates data about the request that the user initiated. The
@@ -72,6 +144,12 @@ class HttpRequest(blackboard.Blackboard):
     additional data that parts of the tree want to set for controllers
     lower down the tree.
     """
+    body_spool_size = 1024*1024
+    """
+    The number of bytes of the request body that are held in memory,
+    any more is moved to a temporary file.
+    """
+
     def __init__(self, wsgi_env):
         # Datestamp immediately,
         self.received = datetime.now()
@@ -87,18 +165,12 @@ class HttpRequest(blackboard.Blackboard):
         # Other data accessed through the environment dictionary.
         self.REQUEST = wsgi_env
 
-        # Incoming data.
-        self.body_params = parse_qs(self.body_raw)
-        self.query_params = parse_qs(self.query_raw)
-        self.all_params = MultipleSourceDict(
-            self.query_params, self.body_params
-            )
-
-        self._parse_cookies(wsgi_env.get('HTTP_COOKIE', ""))
+        # Incoming data (the body, parameters and cookies) is only
+        # parsed when it is first asked for.
 
     def _parse_cookies(self, cookie_string):
         """
-        Adds the given cookie string to this request.
+        Returns a dictionary of the cookies in the given cookie string.
         """
         data = {}
         if cookie_string:
@@ -110,35 +182,114 @@ class HttpRequest(blackboard.Blackboard):
                 match = QUOTED_RE.match(value)
                 if match: value = match.group(1)
                 data[name] = value
-        self.cookies = data
+        return data
 
-    def _get_body_raw(self):
+    def _get_body_params(self):
         try:
-            return self._body_raw
+            return self._body_params
+        except AttributeError:
+            self._body_params = parse_qs(self.body_raw)
+            return self._body_params
+
+    def _set_body_params(self, value):
+        self._body_params = value
+
+    body_params = property(
+        _get_body_params, _set_body_params,
+        doc=("A dictionary of the parameters encoded in the body of the "
+             "request, mapping each name to a list of values.")
+        )
+
+    def _get_query_params(self):
+        try:
+            return self._query_params
+        except AttributeError:
+            self._query_params = parse_qs(self.query_raw)
+            return self._query_params
+
+    def _set_query_params(self, value):
+        self._query_params = value
+
+    query_params = property(
+        _get_query_params, _set_query_params,
+        doc=("A dictionary of the parameters given in the query string, "
+             "mapping each name to a list of values.")
+        )
+
+    def _get_all_params(self):
+        try:
+            return self._all_params
+        except AttributeError:
+            self._all_params = MultipleSourceDict(
+                self.query_params, self.body_params
+                )
+            return self._all_params
+
+    def _set_all_params(self, value):
+        self._all_params = value
+
+    all_params = property(
+        _get_all_params, _set_all_params,
+        doc=("The query and body parameters together. Where a name is "
+             "in both, the query parameters take precedence.")
+        )
+
+    def _get_cookies(self):
+        try:
+            return self._cookies
+        except AttributeError:
+            self._cookies = self._parse_cookies(
+                self.__env.get('HTTP_COOKIE', "")
+                )
+            return self._cookies
+
+    def _set_cookies(self, value):
+        self._cookies = value
+
+    cookies = property(
+        _get_cookies, _set_cookies,
+        doc="A dictionary of the cookies sent with the request."
+        )
+
+    def _get_body_stream(self):
+        try:
+            return self._body_stream
         except AttributeError:
-            # Try to find how much content we were passed.
+            env = self.__env
+
+            # Try to find how much content we were passed. Chunked
+            # bodies have no length: if the server decodes them, it
+            # signals the end of the input, otherwise we decode them.
+            source = env.get('wsgi.input')
             try:
-                content_length = int(self.__env.get('CONTENT_LENGTH', 0))
-            except (ValueError, TypeError):
-                content_length = 0
-
-            if content_length > 0:
-                # Read the input from the designated file-like object and
-                # write it to an output string.
-                output_buffer = StringIO()
-                input_buffer = self.__env['wsgi.input']
-                while content_length > 0:
-                    chunk = input_buffer.read(min(16*1024, content_length))
-                    if not chunk: break
-                    output_buffer.write(chunk)
-                    content_length -= len(chunk)
-
-                self._body_raw = output_buffer.getvalue()
-                output_buffer.close()
-            else:
-                # We had no content.
-                self._body_raw = ''
+                content_length = int(env['CONTENT_LENGTH'])
+            except (KeyError, ValueError, TypeError):
+                if env.get('wsgi.input_terminated'):
+                    content_length = None
+                elif ('chunked' in env.get('HTTP_TRANSFER_ENCODING', '') and
+                      source is not None):
+                    source = ChunkedInput(source)
+                    content_length = None
+                else:
+                    content_length = 0
+
+            self._body_stream = RequestBody(
+                source, content_length, self.body_spool_size
+                )
+            return self._body_stream
+
+    body_stream = property(
+        _get_body_stream,
+        doc=("A file-like :class:`RequestBody` giving incremental access "
+             "to the body of the request. Use this rather than "
+             "``body_raw`` for large uploads.")
+        )
 
+    def _get_body_raw(self):
+        try:
+            return self._body_raw
+        except AttributeError:
+            self._body_raw = self.body_stream.getvalue()
             return self._body_raw
 
     body_raw = property(
@@ -150,6 +301,169 @@ class HttpRequest(blackboard.Blackboard):
 
 QUOTED_RE = re.compile('"(.*)"')
 
+class RequestBody(object):
+    """
+    File-like access to the body of a request.
+
+    Data is only read from the server's input as it is asked for, so
+    large bodies can be processed incrementally. Everything read is
+    kept in a spooled temporary file, which is held in memory until it
+    grows past ``spool_size`` bytes, and moves to disk after
+    that. This means the body can be read again after it has been
+    streamed (to parse the body parameters, for example) without
+    holding a large upload in memory.
+
+    ``content_length`` is the number of bytes to read from ``source``,
+    or None to read until the source is exhausted (for chunked
+    requests).
+    """
+    chunk_size = 16*1024
+
+    def __init__(self, source, content_length, spool_size):
+        self.source = source
+        self.remaining = content_length
+        self.spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.position = 0
+        self.length = 0
+
+    def _fill(self, size):
+        """
+        Reads up to ``size`` more bytes from the source into the
+        spool, returning the number of bytes read.
+        """
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if size <= 0 or self.source is None:
+            return 0
+
+        chunk = self.source.read(size)
+        if not chunk:
+            # The input ended early, so don't try again.
+            self.remaining = 0
+            return 0
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+
+        self.spool.seek(0, 2)
+        self.spool.write(chunk)
+        self.length += len(chunk)
+        return len(chunk)
+
+    def read(self, size=-1):
+        """
+        Reads up to ``size`` bytes, or the rest of the body if no size
+        is given.
+        """
+        if size is None or size < 0:
+            while self._fill(self.chunk_size):
+                pass
+            size = self.length - self.position
+        else:
+            while (self.position + size > self.length and
+                   self._fill(max(size, self.chunk_size))):
+                pass
+
+        self.spool.seek(self.position)
+        data = self.spool.read(size)
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        """Reads up to, and including, the next newline."""
+        if size is None:
+            size = -1
+        while True:
+            self.spool.seek(self.position)
+            line = self.spool.readline(size)
+            if (line.endswith('\n') or 0 <= size <= len(line) or
+                not self._fill(self.chunk_size)):
+                break
+        self.position += len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        """
+        Moves to the given position in the body. This can move
+        backwards to re-read data, or forwards, reading any data
+        skipped over.
+        """
+        while position > self.length and self._fill(self.chunk_size):
+            pass
+        self.position = min(position, self.length)
+
+    def getvalue(self):
+        """
+        Reads the rest of the body, and returns all of it. The current
+        position is unchanged.
+        """
+        position = self.position
+        self.seek(0)
+        data = self.read()
+        self.position = position
+        return data
+
+    def close(self):
+        self.spool.close()
+
+class ChunkedInput(object):
+    """
+    Decodes a request body sent with chunked transfer encoding, for
+    servers that pass it on undecoded. Only the chunks of the body are
+    read from ``source``, so reading stops at the end of the body
+    rather than waiting for the connection to close.
+    """
+    max_line_length = 1024
+
+    def __init__(self, source):
+        self.source = source
+        self.remaining = 0
+        self.finished = False
+
+    def _read_size(self):
+        line = self.source.readline(self.max_line_length)
+        try:
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise HttpError("Invalid chunked request body.", 400)
+        return size
+
+    def read(self, size):
+        """Reads up to ``size`` bytes of the decoded body."""
+        if self.finished:
+            return ''
+        if not self.remaining:
+            self.remaining = self._read_size()
+            if not self.remaining:
+                # Skip any trailing headers.
+                while self.source.readline(self.max_line_length) not in (
+                    '\r\n', '\n', ''
+                    ):
+                    pass
+                self.finished = True
+                return ''
+
+        data = self.source.read(min(size, self.remaining))
+        if not data:
+            # The input ended early.
+            self.finished = True
+            return ''
+        self.remaining -= len(data)
+        if not self.remaining:
+            # Skip the line break that ends the chunk.
+            self.source.readline(self.max_line_length)
+        return data
 
 class Statused(object):
     """
@@ -157,13 +471,20 @@ class Statused(object):
     exceptional. Both need to hold the HTTP status code, so this base
     class provides that functionality.
     """
+    reason = None
+    """
+    The text sent with the status code, if it isn't in
+    :data:`HTTP_STATUS_CODES`.
+    """
+
     def __init__(self, status_code):
         self.status_code = status_code
 
     def _get_status_code_string(self):
-        return "%d %s" % (
-            self.status_code, HTTP_STATUS_CODES[self.status_code]
-            )
+        reason = HTTP_STATUS_CODES.get(self.status_code, self.reason)
+        if reason is None:
+            reason = 'UNKNOWN'
+        return "%d %s" % (self.status_code, reason)
     status_code_string = property(
         _get_status_code_string,
         doc="Human-readable text corresponding to the current status code."
@@ -175,24 +496,130 @@ class HttpResponse(Statused):
     request was correctly handled and a response should be returned to the
     user. Instances of this class should be returned from every controller,
     controllers may also terminate by raising a :class:`HttpError` instnce.
+
+    The content can be given as a string, or as any iterable of
+    strings (such as a generator). Iterable content is streamed: it is
+    passed straight to the server, and each chunk is sent to the user
+    as it is generated, rather than being held in memory. Anything
+    written to a streamed response is sent after the streamed content.
+    If ``content_type`` is None, no ``Content-type`` header is sent.
+    """
+    cacheable = True
     """
+    Set this to False on a response that must not be stored by a
+    :class:`~rowan.controllers.cache.ResponseCache`.
+    """
+
     def __init__(
         self, content=None, content_type='text/html', status_code=200
         ):
         Statused.__init__(self, status_code)
         self.content_type = content_type
         self.content_buffer = StringIO()
+        self.content_iterable = None
         self.extra_headers = []
+        self.close_callbacks = []
         if content:
-            self.content_buffer.write(content)
+            if isinstance(content, basestring):
+                self.content_buffer.write(content)
+            else:
+                self.content_iterable = content
+
+    def _get_streaming(self):
+        return self.content_iterable is not None
+    streaming = property(
+        _get_streaming,
+        doc="True if the content of this response is an iterable."
+        )
 
     def _get_content(self):
+        if self.content_iterable is not None:
+            # Generate the streamed content, so we can return it all.
+            written = self.content_buffer.getvalue()
+            self.content_buffer = StringIO()
+            iterable = self.content_iterable
+            self.content_iterable = None
+            finished = False
+            try:
+                for chunk in iterable:
+                    self.content_buffer.write(chunk)
+                finished = True
+            finally:
+                try:
+                    _close(iterable)
+                finally:
+                    self._run_close_callbacks(finished)
+            self.content_buffer.write(written)
         return self.content_buffer.getvalue()
-    content = property(_get_content)
+    content = property(
+        _get_content,
+        doc=("The complete content of the response. Accessing this on a "
+             "streamed response generates, and stores, all its content.")
+        )
 
     def write(self, content):
         self.content_buffer.write(content)
 
+    def call_on_close(self, callback):
+        """
+        Arranges for ``callback`` to be called once the content of this
+        response has been generated, or has failed to be. It is passed
+        True if all the content was generated, and False otherwise.
+        Use this to release anything streamed content needs while it
+        is being generated.
+        """
+        self.close_callbacks.append(callback)
+
+    def _run_close_callbacks(self, finished):
+        callbacks = self.close_callbacks
+        self.close_callbacks = []
+        for callback in callbacks:
+            callback(finished)
+
+    def iter_content(self, file_wrapper=None):
+        """
+        Returns an iterable of the chunks of content in this response,
+        suitable for returning to the WSGI server. The streamed content
+        can only be iterated once. ``file_wrapper`` is the server's
+        ``wsgi.file_wrapper``, if it has one, which is used by
+        responses that serve a file.
+        """
+        if self.content_iterable is None:
+            self._run_close_callbacks(True)
+            return [self.content_buffer.getvalue()]
+
+        iterable = self.content_iterable
+        self.content_iterable = None
+        written = self.content_buffer.getvalue()
+        if written:
+            iterable = _chain_and_close(iter(iterable), [written], iterable)
+        if self.close_callbacks:
+            callbacks = self.close_callbacks
+            self.close_callbacks = []
+            iterable = _CallbackIterable(iterable, callbacks)
+        return iterable
+
+    def prefetch(self):
+        """
+        Generates the first chunk of a streamed response immediately.
+        Errors raised by the content before anything has been sent to
+        the user can then be handled by the controllers above.
+        """
+        if self.content_iterable is None:
+            return
+        iterable = self.content_iterable
+        try:
+            iterator = iter(iterable)
+            for chunk in iterator:
+                first = [chunk]
+                break
+            else:
+                first = []
+        except:
+            _close(iterable)
+            raise
+        self.content_iterable = _chain_and_close(first, iterator, iterable)
+
     def set_cookie(
         self, key, value, max_age=None, expires=None, path='/', domain=None
         ):
@@ -220,29 +647,190 @@ class HttpResponse(Statused):
             self.extra_headers.append(('Set-Cookie', cookies))
 
     def _get_headers(self):
+        if self.content_type is None:
+            return list(self.extra_headers)
         return [('Content-type', self.content_type)] + self.extra_headers
     headers = property(_get_headers)
 
+class FileResponse(HttpResponse):
+    """
+    A response that sends the contents of an open file.
+
+    The file is never read into memory as a whole. If the server
+    provides ``wsgi.file_wrapper``, the file is handed to it, so it
+    can use a faster platform-specific method to send the file (such
+    as ``sendfile``). Otherwise the file is streamed in blocks.
+    """
+    block_size = 64*1024
+
+    def __init__(
+        self, file, content_type='application/octet-stream', status_code=200
+        ):
+        HttpResponse.__init__(
+            self, _read_blocks(file, self.block_size),
+            content_type, status_code
+            )
+        self.file = file
+        self.file_iterable = self.content_iterable
+        try:
+            self.content_length = os.fstat(file.fileno()).st_size - \
+                file.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            self.content_length = None
+
+    def _is_untouched(self):
+        # Nothing has been read from, or written after, the file.
+        return (self.content_iterable is self.file_iterable and
+                not self.content_buffer.tell())
+
+    def iter_content(self, file_wrapper=None):
+        if file_wrapper is not None and self._is_untouched():
+            # The file is all there is to send, nothing else is needed.
+            self.content_iterable = None
+            self._run_close_callbacks(True)
+            return file_wrapper(self.file, self.block_size)
+        return HttpResponse.iter_content(self)
+
+    def prefetch(self):
+        # Opening the file was the part that could fail.
+        pass
+
+    def _get_headers(self):
+        headers = HttpResponse._get_headers(self)
+        if self.content_length is not None and self._is_untouched():
+            headers.append(('Content-Length', str(self.content_length)))
+        return headers
+    headers = property(_get_headers)
+
+def _read_blocks(file, block_size):
+    """Yields the contents of the given file, then closes it."""
+    try:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        file.close()
+
+def _chain_and_close(first, rest, original):
+    """
+    Yields the chunks in ``first`` then ``rest``, closing the original
+    iterable (as the WSGI server would have) when we're done.
+    """
+    try:
+        for chunk in first:
+            yield chunk
+        for chunk in rest:
+            yield chunk
+    finally:
+        _close(original)
+
+def _close(iterable):
+    """Closes the given iterable, if it can be closed."""
+    close = getattr(iterable, 'close', None)
+    if close is not None:
+        close()
+
+class _CallbackIterable(object):
+    """
+    Wraps streamed content, calling a response's close callbacks when
+    the WSGI server closes it, whether or not it was ever iterated.
+    """
+    def __init__(self, iterable, callbacks):
+        self.iterable = iterable
+        self.callbacks = callbacks
+        self.finished = False
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            yield chunk
+        self.finished = True
+
+    def close(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+        try:
+            _close(self.iterable)
+        finally:
+            for callback in callbacks:
+                callback(self.finished)
+
 class JSONResponse(HttpResponse):
     """
     A specific response subclass that encodes and returns JSON data.
-    """
-    def __init__(self, json_data, status_code=200):
-        def _convert(obj):
-            if (getattr(obj, '__iter__', False) or
-                isinstance(obj, basestring) or
-                isinstance(obj, dict) or
-                isinstance(obj, bool) or
-                isinstance(obj, int) or
-                isinstance(obj, float) or
-                isinstance(obj, long)):
-                return obj
-            else:
-                return str(obj)
 
-        content = json.dumps(json_data, default=_convert)
+    Objects JSON can't represent are converted by the function
+    registered for their exact type in ``converters`` (see
+    :meth:`register_converter`). Objects of other types are turned
+    into lists if they are iterable, or strings if they aren't. To
+    control the encoding completely, pass a ``json.JSONEncoder`` as
+    ``encoder``.
+
+    If ``stream`` is true, the data is encoded as it is sent, in
+    chunks of about ``chunk_size`` bytes, rather than all at once, so
+    very large data doesn't have to be held in memory as one string.
+    Streamed encoding is done in Python, so is slower for small data.
+
+    The data is kept as ``json_data``, so controllers that wrap this
+    one (such as :class:`~rowan.controllers.debug.JSONViewer`) can use
+    it without parsing the JSON.
+    """
+    converters = {
+        set: list,
+        frozenset: list,
+        }
+    chunk_size = 16*1024
+
+    def __init__(self, json_data, status_code=200, encoder=None, stream=False):
+        self.json_data = json_data
+        if encoder is None:
+            encoder = json.JSONEncoder(default=self.convert)
+        if stream:
+            content = _group_chunks(
+                encoder.iterencode(json_data), self.chunk_size
+                )
+        else:
+            content = encoder.encode(json_data)
         HttpResponse.__init__(self, content, "application/json", status_code)
 
+    @classmethod
+    def register_converter(cls, type, converter):
+        """
+        Makes objects of exactly the given type be converted by the
+        given function into something JSON can represent.
+        """
+        # Copied, so subclasses don't change their parents' converters.
+        cls.converters = dict(cls.converters)
+        cls.converters[type] = converter
+
+    def convert(self, obj):
+        """Returns something JSON can represent in place of obj."""
+        converter = self.converters.get(type(obj))
+        if converter is not None:
+            return converter(obj)
+        elif hasattr(obj, '__iter__'):
+            return list(obj)
+        else:
+            return str(obj)
+
+def _group_chunks(chunks, size):
+    """
+    Joins the given small chunks of content into chunks of about the
+    given size.
+    """
+    group = []
+    group_size = 0
+    for chunk in chunks:
+        group.append(chunk)
+        group_size += len(chunk)
+        if group_size >= size:
+            yield ''.join(group)
+            group = []
+            group_size = 0
+    if group:
+        yield ''.join(group)
+
 class Http302(HttpResponse):
     """Indicates that the document has moved."""
     def __init__(self, location):
@@ -253,6 +841,22 @@ class Http302(HttpResponse):
         return HttpResponse._get_headers(self) + [("Location", self.location)]
     headers = property(_get_headers)
 
+class Http304(HttpResponse):
+    """
+    Indicates that the copy of the document the user has cached is
+    still valid. The given headers (such as the document's ``ETag``)
+    are sent with the response.
+    """
+    def __init__(self, headers=()):
+        HttpResponse.__init__(self, None, status_code=304)
+        self.extra_headers.extend(headers)
+
+    def _get_headers(self):
+        # There is no content, so no content type: caches would apply
+        # it to their stored copy.
+        return list(self.extra_headers)
+    headers = property(_get_headers)
+
 class HttpError(Exception, Statused):
     """
     An error raised by a controller to indicate that it was not able
@@ -0,0 +1,331 @@
+"""
+This module contains the WSGI servers used to run applications
+directly, without a separate web server.
+
+For production, :class:`PreforkServer` runs a pool of worker
+processes, so every core can be used. It can be started from the
+command line with the module and name of the application::
+
+    python -m rowan.server --workers 4 --port 8000 mysite.app:application
+"""
+
+import errno
+import gc
+import multiprocessing
+import optparse
+import os
+import Queue
+import signal
+import socket
+import sys
+import threading
+import time
+from wsgiref import simple_server
+
+class ServerHandler(simple_server.ServerHandler):
+    """
+    Extends the standard library's WSGI handler to send files wrapped
+    in ``wsgi.file_wrapper`` straight from the disk to the socket,
+    using ``os.sendfile``, on platforms that support it.
+    """
+    sendfile_block_size = 1024*1024
+
+    def sendfile(self):
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile is None:
+            return False
+        try:
+            in_fd = self.result.filelike.fileno()
+            offset = self.result.filelike.tell()
+            out_fd = self.stdout.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not a real file, or not a real socket.
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        while True:
+            sent = sendfile(out_fd, in_fd, offset, self.sendfile_block_size)
+            if not sent:
+                break
+            offset += sent
+            self.bytes_sent += sent
+        return True
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+    """
+    Handles a single HTTP request, using our :class:`ServerHandler`.
+    """
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = ServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+            )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+class ThreadPoolServer(simple_server.WSGIServer):
+    """
+    A WSGI server that handles requests in a fixed pool of threads, so
+    a request waiting on the database or another service doesn't hold
+    up the others. Each request has its own request object (and so its
+    own context), so controllers don't need to change to be used this
+    way, but anything they share between requests must be thread-safe.
+
+    When every thread is busy, new connections wait in a queue of
+    ``threads`` connections, and then in the socket's backlog, rather
+    than starting more threads.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, threads=10,
+                 bind_and_activate=True):
+        self.threads = threads
+        simple_server.WSGIServer.__init__(
+            self, server_address, handler_class, bind_and_activate
+            )
+
+    def server_activate(self):
+        simple_server.WSGIServer.server_activate(self)
+        self.requests = Queue.Queue(self.threads)
+        self.workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        """Handles queued requests, until given None."""
+        while True:
+            queued = self.requests.get()
+            if queued is None:
+                return
+            request, client_address = queued
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stops listening, and waits for queued requests to finish."""
+        simple_server.WSGIServer.server_close(self)
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def make_server(host, port, application, threads=0):
+    """
+    Creates a WSGI server serving the given application at the given
+    location. If ``threads`` is given, requests are handled by a
+    :class:`ThreadPoolServer` with that many threads, otherwise the
+    server is single-threaded.
+    """
+    if threads:
+        server = ThreadPoolServer((host, port), RequestHandler, threads)
+    else:
+        server = simple_server.WSGIServer((host, port), RequestHandler)
+    server.set_app(application)
+    return server
+
+class PreforkServer(object):
+    """
+    Serves an application from a pool of ``workers`` processes, all
+    accepting connections from one listening socket. The application
+    (and so the whole controller tree) is created before the workers
+    are forked, so they share its memory until they change it. Where
+    the platform supports it, the socket is opened with
+    ``SO_REUSEPORT``, so a new server can start listening on the same
+    port before the old one stops.
+
+    Each worker handles ``max_requests`` requests, then exits and is
+    replaced, limiting the damage from memory leaks (0 means workers
+    are never replaced). Workers that crash are also replaced. Each
+    worker handles requests in a pool of ``threads`` threads, or one
+    at a time if ``threads`` is 0.
+
+    Anything that can't be shared between processes, such as database
+    connections, should be opened after the workers are forked (e.g.
+    when the first request arrives).
+    """
+    def __init__(self, application, host='0.0.0.0', port=8000, workers=None,
+                 max_requests=0, threads=0):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_requests = max_requests
+        self.threads = threads
+        self.socket = None
+        self.pids = {}
+        self.stopping = False
+
+    def bind(self):
+        """Opens the listening socket."""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(ThreadPoolServer.request_queue_size)
+        self.port = self.socket.getsockname()[1]
+
+    def serve_forever(self):
+        """
+        Starts the workers, and replaces them when they exit, until the
+        server is sent SIGTERM or SIGINT.
+        """
+        if self.socket is None:
+            self.bind()
+
+        # Everything loaded so far is shared with the workers. Objects
+        # the collector has frozen aren't touched by collections in the
+        # workers, so the pages holding them aren't copied.
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for i in range(self.workers):
+            self._spawn()
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.pids.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            if time.time() - started < 1:
+                # Don't keep forking workers that fail as they start.
+                time.sleep(1)
+                if self.stopping:
+                    # We were stopped while waiting.
+                    continue
+            self._spawn()
+        self.socket.close()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = time.time()
+            return
+
+        # In the worker.
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._run_worker()
+            status = 0
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        if self.threads:
+            server = ThreadPoolServer(
+                (self.host, self.port), RequestHandler, self.threads, False
+                )
+        else:
+            server = simple_server.WSGIServer(
+                (self.host, self.port), RequestHandler, False
+                )
+
+        # Accept from the shared socket, rather than a new one.
+        server.socket.close()
+        server.socket = self.socket
+        server.server_address = self.socket.getsockname()
+        server.server_name = socket.getfqdn(self.host)
+        server.server_port = self.port
+        server.setup_environ()
+        server.server_activate()
+        server.set_app(self.application)
+
+        if self.max_requests:
+            for i in xrange(self.max_requests):
+                server.handle_request()
+        else:
+            server.serve_forever()
+        server.server_close()
+
+def load_application(name):
+    """
+    Imports an application given as ``module:name`` (e.g.
+    ``mysite.app:application``).
+    """
+    module_name, _, attribute = name.partition(':')
+    module = __import__(module_name, fromlist=['__name__'])
+    return getattr(module, attribute or 'application')
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] module:application")
+    parser.add_option(
+        "-H", "--host", default="0.0.0.0",
+        help="The address to listen on."
+        )
+    parser.add_option(
+        "-p", "--port", type="int", default=8000,
+        help="The port to listen on."
+        )
+    parser.add_option(
+        "-w", "--workers", type="int", default=0,
+        help="The number of worker processes (default: one per CPU)."
+        )
+    parser.add_option(
+        "-t", "--threads", type="int", default=0,
+        help="The number of threads in each worker (default: none)."
+        )
+    parser.add_option(
+        "-m", "--max-requests", type="int", default=0,
+        help="Replace each worker after this many requests."
+        )
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give the application to serve.")
+
+    sys.path.insert(0, os.getcwd())
+    server = PreforkServer(
+        load_application(args[0]), options.host, options.port,
+        workers=options.workers, max_requests=options.max_requests,
+        threads=options.threads
+        )
+    server.bind()
+    print "Serving on http://%s:%d/ with %d workers" % (
+        options.host, server.port, server.workers
+        )
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
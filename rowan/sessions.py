@@ -0,0 +1,198 @@
+"""
+This module contains the stores that
+:class:`~rowan.controllers.middleware.SessionMiddleware` uses to load
+and save sessions.
+
+A store finds a session from the value of the user's session cookie,
+and saves sessions, returning the value the cookie should hold
+afterwards. Sessions are dictionaries with at least an ``id``, a
+``type`` (of "session"), the ``ip`` they were created from and the
+time they ``expires``.
+"""
+
+import base64
+import copy
+import hashlib
+import hmac
+import json
+import zlib
+
+from rowan.utils.cache import LRUCache
+
+class SessionTooLarge(Exception): pass
+
+class SessionStore(object):
+    """
+    The base class for session stores.
+    """
+    def load(self, request, cookie_value):
+        """
+        Returns the session matching the given cookie value, or None
+        if there isn't one.
+        """
+        raise NotImplementedError()
+
+    def save(self, request, session):
+        """
+        Saves the whole of the given session, returning the value the
+        session cookie should hold.
+        """
+        raise NotImplementedError()
+
+    def touch(self, request, session):
+        """
+        Saves a session whose data hasn't changed, except for its
+        expiry time, returning the value the session cookie should
+        hold. Stores can override this to save just the expiry time.
+        """
+        return self.save(request, session)
+
+class MongoSessionStore(SessionStore):
+    """
+    Keeps sessions in a collection of the mongo database. The database
+    middleware must be called before the session middleware.
+    """
+    def __init__(self, collection="session"):
+        self.collection = collection
+
+    def _get_collection(self, request):
+        assert request.db, "Create a database before using sessions."
+        return request.db.mongo[self.collection]
+
+    def load(self, request, cookie_value):
+        return self._get_collection(request).find_one({"id": cookie_value})
+
+    def save(self, request, session):
+        self._get_collection(request).save(session)
+        return session['id']
+
+    def touch(self, request, session):
+        self._get_collection(request).update(
+            {"id": session['id']}, {"$set": {"expires": session['expires']}}
+            )
+        return session['id']
+
+class MemorySessionStore(SessionStore):
+    """
+    Keeps up to ``max_size`` sessions in the memory of this process,
+    discarding the least recently used when it is full. Sessions are
+    not shared between processes, so this is only suitable for
+    single-process servers (or for sessions that don't matter much).
+    """
+    def __init__(self, max_size=10000):
+        self.cache = LRUCache(max_size)
+
+    def load(self, request, cookie_value):
+        # Copies are stored, so requests can't alter each other's data.
+        return copy.deepcopy(self.cache.get(cookie_value))
+
+    def save(self, request, session):
+        self.cache.set(session['id'], copy.deepcopy(dict(session)))
+        return session['id']
+
+class CachedSessionStore(SessionStore):
+    """
+    Adds a local, in-memory cache in front of another store, so that
+    most requests don't need to look their session up. Saves are
+    written through to the other store.
+
+    Other processes may change a session in the other store without
+    this cache knowing, so cached sessions are only trusted for ``ttl``
+    seconds.
+    """
+    def __init__(self, store, max_size=10000, ttl=60):
+        self.store = store
+        self.cache = LRUCache(max_size, ttl=ttl)
+
+    def load(self, request, cookie_value):
+        session = self.cache.get(cookie_value)
+        if session is None:
+            session = self.store.load(request, cookie_value)
+            if session is None:
+                return None
+            self.cache.set(cookie_value, copy.deepcopy(dict(session)))
+            return session
+        return copy.deepcopy(session)
+
+    def save(self, request, session):
+        cookie_value = self.store.save(request, session)
+        self.cache.set(cookie_value, copy.deepcopy(dict(session)))
+        return cookie_value
+
+    def touch(self, request, session):
+        cookie_value = self.store.touch(request, session)
+        self.cache.set(cookie_value, copy.deepcopy(dict(session)))
+        return cookie_value
+
+class SignedCookieSessionStore(SessionStore):
+    """
+    Keeps the whole session in the session cookie, so no database is
+    needed. The cookie is signed with HMAC, so users can't alter their
+    session, but it isn't encrypted, so they can read it: don't store
+    secrets in these sessions. Session data must be JSON serializable.
+
+    ``secret_keys`` is a list of keys: cookies are signed with the
+    first, but accepted if they were signed with any of them, so keys
+    can be rotated by adding a new key at the start of the list and
+    removing old keys once their cookies have expired. If
+    ``compress`` is true, the data is compressed when that makes it
+    smaller. Browsers limit the size of cookies, so saving a session
+    whose cookie would be longer than ``max_size`` raises
+    :class:`SessionTooLarge`.
+    """
+    def __init__(self, secret_keys, compress=True, max_size=4000,
+                 digest=hashlib.sha256):
+        if isinstance(secret_keys, basestring):
+            secret_keys = [secret_keys]
+        assert secret_keys, "Signed sessions need at least one secret key."
+        self.secret_keys = list(secret_keys)
+        self.compress = compress
+        self.max_size = max_size
+        self.digest = digest
+
+    def _sign(self, key, payload):
+        return _encode(hmac.new(key, payload, self.digest).digest())
+
+    def load(self, request, cookie_value):
+        # Check the signature against each of our keys.
+        payload, _, signature = str(cookie_value).rpartition('.')
+        for key in self.secret_keys:
+            if hmac.compare_digest(self._sign(key, payload), signature):
+                break
+        else:
+            return None
+
+        # The first character says how the data is stored.
+        try:
+            data = _decode(payload[1:])
+            if payload[:1] == 'z':
+                data = zlib.decompress(data)
+            return json.loads(data)
+        except (TypeError, ValueError, zlib.error):
+            return None
+
+    def save(self, request, session):
+        data = json.dumps(dict(session), separators=(',', ':'))
+        payload = 'j' + _encode(data)
+        if self.compress:
+            compressed = 'z' + _encode(zlib.compress(data))
+            if len(compressed) < len(payload):
+                payload = compressed
+
+        cookie_value = "%s.%s" % (
+            payload, self._sign(self.secret_keys[0], payload)
+            )
+        if len(cookie_value) > self.max_size:
+            raise SessionTooLarge(
+                "Session cookie of %d bytes is over the %d byte limit." % (
+                    len(cookie_value), self.max_size
+                    )
+                )
+        return cookie_value
+
+def _encode(data):
+    """Base64 encodes data so it can be used in a cookie."""
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
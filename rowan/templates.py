@@ -0,0 +1,121 @@
+"""
+Support for rendering jinja2 templates.
+
+Compiling a template is much slower than rendering it, so the
+environments created here keep compiled templates in a bytecode cache
+on the disk, where every process can find them. New processes then
+only have to load, rather than compile, their templates. The cache can
+be filled as part of deployment, so even the first request to each
+process is fast::
+
+    python -m rowan.templates path/to/templates [more/templates ...]
+
+Pass ``--cache-dir`` if the server uses a cache directory other than
+jinja2's default.
+"""
+
+from __future__ import with_statement
+import optparse
+import os
+import sys
+import threading
+
+import jinja2
+
+import rowan.http as http
+
+def create_environment(template_path, cache_dir=None, **kws):
+    """
+    Returns a new jinja2 environment loading templates from the given
+    path (or list of paths), with compiled templates cached in
+    ``cache_dir`` (or a directory in the system's temporary directory,
+    if not given). Any other keyword arguments are passed on to the
+    environment.
+    """
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_path),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+        **kws
+        )
+
+_environments = {}
+_lock = threading.Lock()
+
+def get_environment(template_path, cache_dir=None):
+    """
+    Returns the environment for templates in the given path, creating
+    it the first time it is asked for. Everything in the process that
+    uses the same templates shares one environment, and so one set of
+    loaded templates.
+    """
+    key = (os.path.abspath(template_path), cache_dir)
+    with _lock:
+        environment = _environments.get(key)
+        if environment is None:
+            environment = create_environment(template_path, cache_dir)
+            _environments[key] = environment
+        return environment
+
+def precompile(environment, extensions=None):
+    """
+    Compiles every template the given environment can find (or those
+    with the given file extensions), storing them in its bytecode
+    cache. Returns the number of templates compiled.
+    """
+    names = environment.list_templates(extensions=extensions)
+    for name in names:
+        environment.get_template(name)
+    return len(names)
+
+def render_response(template, data=None, content_type="text/html",
+                    encoding="utf-8", stream=False, buffer_size=16):
+    """
+    Renders the given template with the given data, returning the
+    result in a :class:`~rowan.http.HttpResponse`.
+
+    If ``stream`` is true, the page is rendered as it is sent, so the
+    user starts receiving large pages sooner, and the whole page is
+    never held in memory. ``buffer_size`` pieces of the template are
+    rendered before each chunk is sent. Errors raised while rendering
+    a streamed page can only be handled by the controllers above if
+    they are raised before the first chunk (see
+    :class:`~rowan.controllers.core.ErrorHandler`).
+    """
+    if data is None:
+        data = {}
+    if stream:
+        chunks = template.stream(**data)
+        chunks.enable_buffering(buffer_size)
+        content = (chunk.encode(encoding) for chunk in chunks)
+    else:
+        content = template.render(**data).encode(encoding)
+    return http.HttpResponse(
+        content, content_type="%s; charset=%s" % (content_type, encoding)
+        )
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] directory [directory ...]"
+        )
+    parser.add_option(
+        "-c", "--cache-dir", default=None,
+        help="The bytecode cache directory (default: jinja2's)."
+        )
+    parser.add_option(
+        "-e", "--extension", action="append", dest="extensions",
+        help="Only compile templates with this extension (repeatable)."
+        )
+    options, directories = parser.parse_args(argv)
+    if not directories:
+        parser.error("Give at least one template directory.")
+
+    extensions = None
+    if options.extensions:
+        extensions = [ext.lstrip('.') for ext in options.extensions]
+    for directory in directories:
+        environment = create_environment(directory, options.cache_dir)
+        count = precompile(environment, extensions)
+        print "%s: %d template(s) compiled." % (directory, count)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,7 +4,6 @@ for storing and communicating data and settings in Rowan.
 """
 
 from __future__ import with_statement
-import contextlib
 
 class Blackboard(object):
     """A data store who's value updates are reversable.
@@ -30,7 +29,6 @@ class Blackboard(object):
     2
     """
 
-    @contextlib.contextmanager
     def set(self, **kws):
         """
         A context for temporarily setting values in the request.
@@ -49,49 +47,85 @@ class Blackboard(object):
         this blackboard, intermediate objects given with nested keys
         will be created as empty blackboards, if they don't already exist.
         """
+        return _Scope(self, kws)
+
+class _Scope(object):
+    """
+    The context manager returned by :meth:`Blackboard.set`. This does
+    the same job as a ``contextlib.contextmanager`` generator, but
+    without the overhead of creating and resuming a generator, which
+    matters because it is used several times for every request.
+    """
+    def __init__(self, blackboard, kws):
+        self.blackboard = blackboard
+        self.kws = kws
+
+    def __enter__(self):
         # Make the changes, storing the old versions for future use.
-        old_values = {}
-        new_values = []
-        for key, value in kws.items():
-            # Work out the nesting of this parameter
-            components = key.split('__')
-
-            # Go through the components and see if they exist
-            obj = self
-            found_new = False
-            for component in components[:-1]:
-                if hasattr(obj, component):
-                    obj = getattr(obj, component)
-                else:
-                    if not found_new:
-                        # This is the first new item we're creating,
-                        # so add it to the new list.
-                        new_values.append((obj, component))
-                        found_new = True
-
-                    # Set the blackboard in the given slot and recurse into it.
-                    blackboard = Blackboard()
-                    setattr(obj, component, blackboard)
-                    obj = blackboard
-
-            # The final stage should be the value, not a blackboard.
-            last_component = components[-1]
-            if hasattr(obj, last_component):
-                old_values[(obj, last_component)]=getattr(obj, last_component)
-            elif not found_new:
-                new_values.append((obj, last_component))
-            setattr(obj, last_component, value)
-
-        # Yield back to the context.
+        self.old_values = old_values = []
+        self.new_values = new_values = []
         try:
-            yield
+            for key, value in self.kws.iteritems():
+                # Work out the nesting of this parameter
+                parents, last_component = _split_key(key)
+
+                # Go through the components and see if they exist
+                obj = self.blackboard
+                found_new = False
+                for component in parents:
+                    child = getattr(obj, component, _MISSING)
+                    if child is not _MISSING:
+                        obj = child
+                    else:
+                        if not found_new:
+                            # This is the first new item we're creating,
+                            # so add it to the new list.
+                            new_values.append((obj, component))
+                            found_new = True
+
+                        # Set the blackboard in the given slot and
+                        # recurse into it.
+                        blackboard = Blackboard()
+                        setattr(obj, component, blackboard)
+                        obj = blackboard
 
+                # The final stage should be the value, not a blackboard.
+                if not found_new:
+                    old_value = getattr(obj, last_component, _MISSING)
+                    if old_value is _MISSING:
+                        new_values.append((obj, last_component))
+                    else:
+                        old_values.append((obj, last_component, old_value))
+                setattr(obj, last_component, value)
+        except:
+            # Undo whatever we managed to change.
+            self.__exit__(None, None, None)
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
         # Reset everything back to how it was.
-        finally:
-            for (obj, key), value in old_values.items():
-                setattr(obj, key, value)
-            for (obj, key) in reversed(new_values):
-                delattr(obj, key)
+        for obj, key, value in reversed(self.old_values):
+            setattr(obj, key, value)
+        for obj, key in reversed(self.new_values):
+            delattr(obj, key)
+        return False
+
+_MISSING = object()
+
+_split_keys = {}
+
+def _split_key(key):
+    """
+    Splits a nested key into a tuple of its parent components and its
+    final component. The same keys are used over and over again, so
+    the results are cached.
+    """
+    try:
+        return _split_keys[key]
+    except KeyError:
+        components = key.split('__')
+        result = _split_keys[key] = (tuple(components[:-1]), components[-1])
+        return result
 
 if __name__ == '__main__':
     import doctest
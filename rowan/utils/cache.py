@@ -0,0 +1,142 @@
+"""
+This module provides the :class:`LRUCache` class, a bounded in-process
+cache used by controllers that want to remember expensive results.
+"""
+
+from __future__ import with_statement
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache(object):
+    """
+    A dictionary-like cache holding at most ``max_size`` entries. When
+    the cache is full, the entry that was least recently used is
+    discarded to make room. The cache counts its hits and misses, so
+    its effectiveness can be monitored.
+
+    If ``size_of`` is given, it is called with each value to find its
+    size, and ``max_size`` limits the total size of the values rather
+    than their number (e.g. to limit the cache to a number of bytes).
+
+    If ``ttl`` is given, entries expire that many seconds after they
+    are set. Individual entries can be given their own time to live
+    when they are set.
+
+    >>> c = LRUCache(2)
+    >>> c.set('a', 1)
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> print c.get('b')
+    None
+    >>> c.hits, c.misses
+    (1, 1)
+    >>> c.set('d', 4, ttl=-1)
+    >>> print c.get('d')
+    None
+    """
+    def __init__(self, max_size, size_of=None, ttl=None):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps each key to a (value, expiry time) pair.
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        if self.size_of is None:
+            return 1
+        return self.size_of(value)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the given key, marking it as
+        recently used, or the default if the key isn't cached (or has
+        expired).
+        """
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                self.size -= self._size(value)
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value for the given key, discarding the least recently
+        used entries if the cache is full. The entry expires after
+        ``ttl`` seconds, if given, or the cache's default time to live.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is not None:
+            expires = time.time() + ttl
+        else:
+            expires = None
+
+        size = self._size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                # This could never fit.
+                return
+            self._data[key] = (value, expires)
+            self.size += size
+            while self.size > self.max_size:
+                old_key, (old_value, old_expires) = \
+                    self._data.popitem(last=False)
+                self.size -= self._size(old_value)
+
+    def _remove(self, key):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.size -= self._size(value)
+
+    def delete(self, key):
+        """Removes the given key from the cache, if it is present."""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Removes everything from the cache, and resets the counters."""
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _get_hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+    hit_rate = property(
+        _get_hit_rate,
+        doc="The fraction of lookups that have found a cached value."
+        )
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,109 @@
+"""
+Creates gzipped copies of static files, for
+:class:`~rowan.controllers.content.ContentServer` to send to browsers
+that accept them. Run this over your media directories as part of
+deployment::
+
+    python -m rowan.utils.precompress path/to/media [more/media ...]
+
+Each compressible file gets a copy with a ``.gz`` extension next to
+it, with the same modification time. Copies that are already up to
+date are skipped, and files that don't get smaller are left alone.
+"""
+
+import gzip
+import optparse
+import os
+import sys
+
+COMPRESSIBLE_EXTENSIONS = set([
+    'css', 'csv', 'htm', 'html', 'ico', 'js', 'json', 'svg', 'txt',
+    'xhtml', 'xml', 'xsl', 'xslt'
+    ])
+"""The extensions of files that are worth compressing."""
+
+def precompress_file(path, level=9, min_size=256):
+    """
+    Writes a gzipped copy of the given file, if it is out of date and
+    is worth compressing. Returns True if a copy was written.
+    """
+    gzip_path = path + '.gz'
+    stats = os.stat(path)
+    if stats.st_size < min_size:
+        return False
+    try:
+        if int(os.stat(gzip_path).st_mtime) >= int(stats.st_mtime):
+            return False
+    except OSError:
+        pass
+
+    # Compress into a temporary file, so the server never sees a
+    # partial copy.
+    temp_path = gzip_path + '.tmp'
+    source = open(path, 'rb')
+    try:
+        output = gzip.GzipFile(
+            temp_path, 'wb', level, mtime=int(stats.st_mtime)
+            )
+        try:
+            while True:
+                block = source.read(64*1024)
+                if not block:
+                    break
+                output.write(block)
+        finally:
+            output.close()
+    finally:
+        source.close()
+
+    if os.path.getsize(temp_path) >= stats.st_size:
+        # Not worth it, remove any stale copy too.
+        os.remove(temp_path)
+        if os.path.exists(gzip_path):
+            os.remove(gzip_path)
+        return False
+
+    os.utime(temp_path, (stats.st_atime, stats.st_mtime))
+    os.rename(temp_path, gzip_path)
+    return True
+
+def precompress_tree(base_path, extensions=COMPRESSIBLE_EXTENSIONS,
+                     level=9, min_size=256):
+    """
+    Writes gzipped copies of the compressible files in the given
+    directory tree. Returns the number of copies written.
+    """
+    count = 0
+    for directory, dirnames, filenames in os.walk(base_path):
+        for filename in filenames:
+            extension = filename.split('.')[-1].lower()
+            if extension in extensions:
+                path = os.path.join(directory, filename)
+                if precompress_file(path, level, min_size):
+                    count += 1
+    return count
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] directory [directory ...]"
+        )
+    parser.add_option(
+        "-l", "--level", type="int", default=9,
+        help="The gzip compression level (1-9)."
+        )
+    parser.add_option(
+        "-m", "--min-size", type="int", default=256,
+        help="Files smaller than this many bytes are left alone."
+        )
+    options, directories = parser.parse_args(argv)
+    if not directories:
+        parser.error("Give at least one directory to compress.")
+
+    for directory in directories:
+        count = precompress_tree(
+            directory, level=options.level, min_size=options.min_size
+            )
+        print "%s: %d file(s) compressed." % (directory, count)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
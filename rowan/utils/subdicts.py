@@ -2,6 +2,11 @@ class ChangeTrackingDict(dict):
     """
     A dictionary subclass that has a field for tracking if the
     dictionary is dirty and needs saving.
+
+    Only changes to the dictionary itself are tracked: changing a
+    mutable value held in the dictionary (such as a nested dictionary)
+    in place doesn't make this dictionary dirty. Assign a new value
+    instead.
     """
     def __init__(self, *args, **kws):
         super(ChangeTrackingDict, self).__init__(*args, **kws)
@@ -16,9 +21,37 @@ class ChangeTrackingDict(dict):
             # Quick version if we're already dirty.
             super(ChangeTrackingDict, self).__setitem__(key, value)
         else:
-            old_value = self[key]
+            old_value = self.get(key, _MISSING)
             super(ChangeTrackingDict, self).__setitem__(key, value)
-            self.dirty = (old_value != value)
+            self.dirty = (old_value is _MISSING or old_value != value)
+
+    def __delitem__(self, key):
+        super(ChangeTrackingDict, self).__delitem__(key)
+        self.dirty = True
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kws):
+        for key, value in dict(*args, **kws).iteritems():
+            self[key] = value
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty = True
+        return super(ChangeTrackingDict, self).pop(key, *default)
+
+    def popitem(self):
+        item = super(ChangeTrackingDict, self).popitem()
+        self.dirty = True
+        return item
+
+    def clear(self):
+        if self:
+            self.dirty = True
+        super(ChangeTrackingDict, self).clear()
 
     def clean(self):
         """
@@ -27,6 +60,8 @@ class ChangeTrackingDict(dict):
         """
         self.dirty = False
 
+_MISSING = object()
+
 class MultipleSourceDict(object):
     """
     A dictionary-like object that delegates to a number of other